@@ -0,0 +1,19 @@
+"""
+Convert the pickled models in AI-models/ to the native XGBoost format.
+
+Usage: python migrate_models.py [--remove-pickle]
+"""
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data.models import MODELS, migrate_pickled_models
+
+
+if __name__ == '__main__':
+    remove_pickle = "--remove-pickle" in sys.argv[1:]
+    migrated = migrate_pickled_models(MODELS, remove_pickle=remove_pickle)
+    for model in MODELS:
+        status = "migrated" if model.perk in migrated else "skipped (no pickle)"
+        print(f"{model.perk}: {status} -> {model.model_file.name}")
@@ -1,84 +1,140 @@
+import hashlib
+import json
+import os
 import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import List
+from typing import List, TYPE_CHECKING
 
 import pandas as pd
-import xgboost as xgb
-from matplotlib import pyplot as plt
-from sklearn.metrics import mean_squared_error
-from sklearn.model_selection import train_test_split
 
-from data.plotting import plot_forecast
 from data.spots import ZV
 from data.spots import SPOTS
 
+if TYPE_CHECKING:
+    import xgboost as xgb
+
+# xgboost, sklearn and matplotlib are imported where they are used: they are only needed for training and plotting,
+# importing them here would slow down every web worker (pickled models import xgboost when first loaded)
+
+
+def fit_model(X, y, n_jobs=None):
+    """Fit a regressor on a random train/test split, returns the model and the test and train error"""
+    import xgboost as xgb
+    from sklearn.metrics import mean_squared_error
+    from sklearn.model_selection import train_test_split
+
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3)
+
+    model = xgb.XGBRegressor(
+        objective='reg:squarederror',
+        max_depth=1,  # Use max_leaves instead
+        max_leaves=8,  # Limit number of leaves for regularization
+        subsample=0.6,  # More randomness
+        colsample_bytree=0.6,  # More randomness
+        min_child_weight=8,  # Require more samples per leaf
+        reg_alpha=1.0,  # Stronger L1 regularization
+        reg_lambda=5.0,  # Stronger L2 regularization
+        learning_rate=0.03,  # Lower learning rate
+        n_estimators=600,  # More trees
+        tree_method='hist',
+        booster='gbtree',
+        random_state=42,
+        n_jobs=n_jobs
+    )
+    model.fit(X_train, y_train,
+              eval_set=[(X_test, y_test)],
+              verbose=False)
+
+    y_pred_test = model.predict(X_test)
+    y_pred_train = model.predict(X_train)
+
+    mse_train = mean_squared_error(y_train, y_pred_train)
+    mse_test = mean_squared_error(y_test, y_pred_test)
+    return model, mse_test, mse_train
+
+
+def fit_best_model(X, y, perk, attempts=10, overtrain_limit=0.75, verbose=True, n_jobs=None):
+    """Fit several times and keep the model with the lowest test error that is not overtrained"""
+    model_best = None
+    rms_best = 9999
+    i = 0
+    while i < attempts:
+        i += 1
+        model, rms_test, rms_train = fit_model(X, y, n_jobs=n_jobs)
+        if verbose:
+            print(f'RMS {perk}: train={rms_train:.2f}, test={rms_test:.2f} (from {len(X)} feedback entries)')
+        overtrained = rms_train < (rms_test * overtrain_limit)
+        if rms_test < rms_best and not overtrained:
+            rms_best = rms_test
+            model_best = model
+        elif overtrained:
+            attempts += 1
+    return model_best, rms_best
+
+
+def training_set(dfs: pd.DataFrame, perk: str, channels: List[str]):
+    """Inputs and target of a perk, only rows with feedback on that perk"""
+    dfs = dfs[dfs[perk].notnull()]
+    dfs = dfs[channels + [perk]]
+    X = dfs.drop(perk, axis=1)
+    y = dfs[perk]
+    return X, y
+
+
+def training_frame(spots, perks: List[str], match_all_feedback_times=True) -> pd.DataFrame:
+    """Hindcast of all spots combined with the feedback of all perks at once"""
+    dfs = []
+    for spot in spots:
+        df = spot.training_data(only_spot_data=True, non_zero_only=False,
+                                match_all_feedback_times=match_all_feedback_times, fb_columns=list(perks))
+        dfs.insert(0, df[df[list(perks)].notnull().any(axis=1)])
+    return pd.concat(dfs)
+
 
 class Model:
     def __init__(self, perk: str, channels, model=None):
         self.perk = perk
-        self.model: xgb.XGBModel = model if model is not None else self._load_model()
+        self._model = model
         self.channels = channels
 
-    def train(self, spots, perk: str, channels: List[str], verbose=False, save=True, match_all_feedback_times=True):
-        """Train a model, save it and returns the model"""
-        dfs = pd.DataFrame()
-        for spot in spots:
-            df = spot.training_data(only_spot_data=True, match_all_feedback_times=match_all_feedback_times,
-                                    fb_columns=perk)
-            dfs = pd.concat([df, dfs])
-
-        # print(f"Training {perk} with {len(dfs)} feedback entries from {len(spots)} spots")
-        dfs = dfs[channels + [perk]]
-        X = dfs.drop(perk, axis=1)
-        y = dfs[perk]
-
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3)
-
-        self.model = xgb.XGBRegressor(
-            objective='reg:squarederror',
-            max_depth=1,  # Use max_leaves instead
-            max_leaves=8,  # Limit number of leaves for regularization
-            subsample=0.6,  # More randomness
-            colsample_bytree=0.6,  # More randomness
-            min_child_weight=8,  # Require more samples per leaf
-            reg_alpha=1.0,  # Stronger L1 regularization
-            reg_lambda=5.0,  # Stronger L2 regularization
-            learning_rate=0.03,  # Lower learning rate
-            n_estimators=600,  # More trees
-            tree_method='hist',
-            booster='gbtree',
-            random_state=42
-        )
-        self.model.fit(X_train, y_train,
-                       eval_set=[(X_test, y_test)],
-                       verbose=False)
+    @property
+    def model(self) -> "xgb.XGBModel":
+        """The trained model, loaded from file on first use"""
+        if self._model is None:
+            self._model = self._load_model()
+        return self._model
 
-        y_pred_test = self.model.predict(X_test)
-        y_pred_train = self.model.predict(X_train)
+    @model.setter
+    def model(self, model):
+        self._model = model
 
-        mse_train = mean_squared_error(y_train, y_pred_train)
-        mse_test = mean_squared_error(y_test, y_pred_test)
+    def predict(self, X):
+        return self.model.predict(X)
 
+    def train(self, spots, perk: str, channels: List[str], verbose=False, save=True, match_all_feedback_times=True):
+        """Train a model, save it and returns the model"""
+        dfs = training_frame(spots, [perk], match_all_feedback_times=match_all_feedback_times)
+        X, y = training_set(dfs, perk, channels)
+        self.model, mse_test, mse_train = fit_model(X, y)
 
         if verbose:
-            print(f'RMS {perk}: train={mse_train:.2f}, test={mse_test:.2f} (from {len(dfs)} feedback entries)')
+            print(f'RMS {perk}: train={mse_train:.2f}, test={mse_test:.2f} (from {len(X)} feedback entries)')
         if save:
-            self.save_model()
+            self.save_model(metadata={"rms_test": float(mse_test), "rms_train": float(mse_train), "n_feedback": len(X)})
         return mse_test, mse_train
 
 
     @classmethod
     def train_new(cls, spots, perk: str, channels: List[str], verbose=False, save=True, match_all_feedback_times=True):
         # double with train. Temp.
-        dfs = pd.DataFrame()
-        for spot in spots:
-            df = spot.training_data(only_spot_data=True, match_all_feedback_times=match_all_feedback_times,
-                                    fb_columns=perk)
-            dfs = pd.concat([df, dfs])
+        import xgboost as xgb
+        from sklearn.model_selection import train_test_split
 
-        dfs = dfs[channels + [perk]]
-        X = dfs.drop(perk, axis=1)
-        y = dfs[perk]
+        dfs = training_frame(spots, [perk], match_all_feedback_times=match_all_feedback_times)
+        X, y = training_set(dfs, perk, channels)
 
         X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3)
 
@@ -104,44 +160,85 @@ class Model:
 
 
     def train_best(self, spots, perk: str, channels: List[str], verbose=True, save=True, match_all_feedback_times=True, attempts=10, overtrain_limit=0.75):
-        model_best = None
-        rms_best = 9999
-        i = 0
-        while i < attempts:
-            i += 1
-            rms_test, rms_train = self.train(spots, perk=perk, channels=channels, save=False, verbose=True, match_all_feedback_times=match_all_feedback_times)
-            model = self.model
-            overtrained = rms_train < (rms_test * overtrain_limit)
-            if rms_test < rms_best and not overtrained:
-                rms_best = rms_test
-                model_best = model
-                if save:
-                    self.save_model()
-                # if verbose:
-                #     print(f"new best model: {perk}:\t{rms:.2f}")
-            elif overtrained:
-                attempts += 1
-
-
+        dfs = training_frame(spots, [perk], match_all_feedback_times=match_all_feedback_times)
+        X, y = training_set(dfs, perk, channels)
+        model_best, rms_best = fit_best_model(X, y, perk, attempts=attempts, overtrain_limit=overtrain_limit)
         self.model = model_best
+        if save and model_best is not None:
+            self.save_model(metadata={"rms_test": float(rms_best), "n_feedback": len(X), "attempts": attempts})
 
 
     def _load_model(self):
-        if not self.model_file.is_file():
-            raise NotImplementedError("Use .train() first to train a model")
+        """Load the model from the native XGBoost file, falls back to a legacy pickle not yet migrated locally"""
+        if self.model_file.is_file():
+            return self._load_native_model()
+        if self.legacy_model_file.is_file():
+            with open(self.legacy_model_file, 'rb') as f:
+                return pickle.load(f)
+        raise NotImplementedError("Use .train() first to train a model")
+
+    def _load_native_model(self):
+        import xgboost as xgb
+
         with open(self.model_file, 'rb') as f:
-            model = pickle.load(f)
+            raw = f.read()
+        manifest = self.manifest()
+        if manifest.get("sha256") != hashlib.sha256(raw).hexdigest():
+            raise ValueError(f"Checksum of {self.model_file.name} does not match its manifest")
+        model = xgb.XGBRegressor()
+        model.load_model(bytearray(raw))
         return model
 
-    def save_model(self):
+    def save_model(self, metadata=None):
+        """Save the model in the native XGBoost (UBJSON) format, along with a manifest"""
+        import xgboost as xgb
+
+        raw = self.model.get_booster().save_raw(raw_format="ubj")
         with open(self.model_file, 'wb') as f:
-            pickle.dump(self.model, f)
+            f.write(raw)
+        manifest = {
+            "perk": self.perk,
+            "channels": list(self.channels),
+            "format": "ubj",
+            "sha256": hashlib.sha256(raw).hexdigest(),
+            "xgboost_version": xgb.__version__,
+            "saved": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "training": metadata or {},
+        }
+        with open(self.manifest_file, 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    def manifest(self) -> dict:
+        with open(self.manifest_file, 'r') as f:
+            return json.load(f)
 
     @property
     def model_file(self):
         base_dir = Path(__file__).resolve().parent
-        return base_dir / f"AI-models/model_XGBRegressor_ZV_{self.perk}.pkl"  # todo remove ZV
+        return base_dir / f"AI-models/model_XGBRegressor_ZV_{self.perk}.ubj"  # todo remove ZV
+
+    @property
+    def manifest_file(self):
+        return self.model_file.with_suffix(".json")
+
+    @property
+    def legacy_model_file(self):
+        return self.model_file.with_suffix(".pkl")
+
 
+def migrate_pickled_models(models, remove_pickle=False):
+    """Convert pickled models to the native XGBoost format, returns the perks that were converted"""
+    migrated = []
+    for model in models:
+        if not model.legacy_model_file.is_file():
+            continue
+        with open(model.legacy_model_file, 'rb') as f:
+            model.model = pickle.load(f)
+        model.save_model(metadata={"migrated_from": model.legacy_model_file.name})
+        if remove_pickle:
+            model.legacy_model_file.unlink()
+        migrated.append(model.perk)
+    return migrated
 
 
 # forecast_columns = ["rating", "hoog", "clean", "krachtig", "stijl", "stroming", "windy"]
@@ -162,13 +259,53 @@ for perk, in_columns in forecast_columns.items():
     MODELS.append(model)
 
 
+def _train_perk(perk, X, y, attempts, overtrain_limit, n_jobs):
+    t_start = time.perf_counter()
+    model, rms = fit_best_model(X, y, perk, attempts=attempts, overtrain_limit=overtrain_limit, verbose=False,
+                                n_jobs=n_jobs)
+    return model, rms, time.perf_counter() - t_start
+
+
+def train_all(models, spots, attempts=3, overtrain_limit=0.75, save=True, workers=None, match_all_feedback_times=True):
+    """Train the models of all perks in parallel
+
+    The training data is built once for all perks, after which every perk is trained in its own process. The cores
+    are divided over the processes (XGBoost n_jobs) so they are not oversubscribed.
+    """
+    t_start = time.perf_counter()
+    dfs = training_frame(spots, [model.perk for model in models], match_all_feedback_times=match_all_feedback_times)
+    print(f"Training data of {len(spots)} spots built in {time.perf_counter() - t_start:.1f} s")
+
+    n_cores = os.cpu_count() or 1
+    workers = workers or min(len(models), n_cores)
+    n_jobs = max(1, n_cores // workers)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = {}
+        for model in models:
+            X, y = training_set(dfs, model.perk, model.channels)
+            jobs[pool.submit(_train_perk, model.perk, X, y, attempts, overtrain_limit, n_jobs)] = model
+        for job in as_completed(jobs):
+            model = jobs[job]
+            model_best, rms, seconds = job.result()
+            print(f"Trained {model.perk}: RMS test={rms:.2f} in {seconds:.1f} s")
+            if model_best is None:
+                continue
+            model.model = model_best
+            if save:
+                model.save_model(metadata={"rms_test": float(rms), "n_feedback": int(dfs[model.perk].notnull().sum()),
+                                           "attempts": attempts, "seconds": round(seconds, 1)})
+    print(f"Trained {len(models)} models in {time.perf_counter() - t_start:.1f} s using {workers} processes")
+
+
 if __name__ == '__main__':
+    from matplotlib import pyplot as plt
+    from data.plotting import plot_forecast
+
     # Train models
     attenpts = 3
     rating = MODELS[0]
     # rating.train_best(spots, perk=rating.perk, channels=rating.channels, save=True, verbose=True, attempts=attenpts)
-    for model in MODELS:
-        model.train_best(SPOTS, perk=model.perk, channels=model.channels, save=True, attempts=attenpts)
+    train_all(MODELS, SPOTS, attempts=attenpts, save=True)
 
 
     spot = ZV
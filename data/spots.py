@@ -1,11 +1,10 @@
 import pandas as pd
 import numpy as np
-from copy import deepcopy, copy
+from copy import copy
 import datetime
-import re
-from dataclasses import dataclass, fields
-
-import pytz
+import pickle
+from dataclasses import dataclass, fields, astuple
+from pathlib import Path
 
 import surffeedback, stormglass
 
@@ -14,27 +13,30 @@ def shelter_from_series(signal_richting, spot):
     # Add shelter
     angle_wind = compute_angle(signal_richting, spot.richting+90)
     if spot.spot_info.pier == -1:
-        return angle_wind.apply(compute_shelter)
+        return pd.Series(compute_shelter_array(angle_wind.values), index=angle_wind.index)
     elif spot.spot_info.pier == 0:
         return 0
     elif spot.spot_info.pier == 1:
-        return (-angle_wind).apply(compute_shelter)
+        return pd.Series(compute_shelter_array(-angle_wind.values), index=angle_wind.index)
     else:
         raise NotImplementedError("Pier not implemented")
 
+
+# Piecewise-linear shelter curve: 0 -> 0.4 at 20°, up to 0.7 at 90°, back to 0.4 at 160° and 0 at 180°
+SHELTER_ANGLES = [0, 20, 90, 160, 180]
+SHELTER_FACTORS = [0, 0.4, 0.7, 0.4, 0]
+
+
+def compute_shelter_array(shelter_angle) -> np.ndarray:
+    """Shelter factor for an array of angles. Zero outside 0-180° and for missing angles."""
+    shelter_angle = np.asarray(shelter_angle, dtype=float)
+    shelter = np.interp(shelter_angle, SHELTER_ANGLES, SHELTER_FACTORS, left=0, right=0)
+    return np.where(np.isnan(shelter_angle), 0, shelter)
+
+
 def compute_shelter(shelter_angle):
-    if 0 <= shelter_angle <= 20 or 160 <= shelter_angle <= 180:
-        # Linear increase from 0 to 0.4 and then decrease back
-        return 0.4 / 20 * min(shelter_angle, 180 - shelter_angle)
-    elif 20 < shelter_angle < 160:
-        # Linear increase from 0.4 to 0.7 up to 90°, then decrease back to 0.4
-        if shelter_angle <= 90:
-            return 0.4 + (0.7 - 0.4) / (90 - 20) * (shelter_angle - 20)
-        else:
-            return 0.4 + (0.7 - 0.4) / (90 - 20) * (160 - shelter_angle)
-    else:
-        # Zero reduction factor beyond 180°
-        return 0
+    """Shelter factor for a single angle, see compute_shelter_array"""
+    return float(compute_shelter_array(shelter_angle))
 
 
 def compute_angle(data: pd.DataFrame, richting: float):
@@ -74,6 +76,95 @@ def enrich_input_data(data: pd.DataFrame, spot) -> pd.DataFrame:
     return data
 
 
+def feedback_intervals(feedback: pd.DataFrame, match_all_feedback_times=True):
+    """Session start and end of every feedback entry as UTC nanoseconds
+
+    Entries without a hh:mm:ss start and end time are dropped; the remaining feedback is returned along with the
+    times, in the original order. With match_all_feedback_times=False only the 10 minutes around the middle of the
+    session are used.
+    """
+    pattern = r'^\d{2}:\d{2}:\d{2}$'
+    valid = feedback['Start tijd'].astype(str).str.match(pattern) & feedback['Eind tijd'].astype(str).str.match(pattern)
+    feedback = feedback[valid]
+    datum = feedback["Datum"].astype(str)
+    start_tijd = pd.to_datetime(datum + " " + feedback['Start tijd'], format="%d-%m-%Y %H:%M:%S")
+    eind_tijd = pd.to_datetime(datum + " " + feedback['Eind tijd'], format="%d-%m-%Y %H:%M:%S")
+    if not match_all_feedback_times:
+        mid_tijd = start_tijd + ((eind_tijd - start_tijd) / 2)
+        start_tijd = mid_tijd - datetime.timedelta(minutes=5)
+        eind_tijd = mid_tijd + datetime.timedelta(minutes=5)
+
+    def to_utc(tijd):
+        # Same as pytz localize(): ambiguous times are winter time, non-existing times are shifted one hour
+        tijd = tijd.dt.tz_localize("Europe/Amsterdam", ambiguous=np.zeros(len(tijd), dtype=bool),
+                                   nonexistent=datetime.timedelta(hours=1))
+        return pd.DatetimeIndex(tijd).asi8
+
+    return feedback, to_utc(start_tijd), to_utc(eind_tijd)
+
+
+def match_feedback(times, start_tijd, eind_tijd) -> np.ndarray:
+    """Position of the feedback entry covering each time, -1 if none
+
+    Sessions are matched inclusive on both ends with a sorted-index interval join. When sessions overlap the last
+    feedback entry wins.
+    """
+    order = np.argsort(times, kind="stable")
+    times_sorted = times[order]
+    lo = np.searchsorted(times_sorted, start_tijd, side="left")
+    hi = np.searchsorted(times_sorted, eind_tijd, side="right")
+    owner = np.full(len(times), -1)
+    for i, (a, b) in enumerate(zip(lo, hi)):
+        owner[order[a:b]] = i
+    return owner
+
+
+HINDCAST_STORE_DIR = None  # Directory to also persist the enriched hindcasts to disk, None for memory only
+_HINDCAST_STORE = {}
+
+
+def enriched_hindcast(spot) -> pd.DataFrame:
+    """Historical stormglass data of the spot including all features
+
+    The result is cached per (db_name, spot, file modification time), so the raw data is loaded and enriched once and
+    automatically reloaded when the stored data changes. The returned frame is shared: copy it before modifying.
+    """
+    mtime = stormglass.data_mtime(spot.db_name)
+    if mtime is None:
+        return enrich_input_data(stormglass.load_data(spot.db_name), spot)
+
+    key = (spot.db_name, astuple(spot), mtime)
+    if key not in _HINDCAST_STORE:
+        data = _load_persisted_hindcast(spot, key)
+        if data is None:
+            data = enrich_input_data(stormglass.load_data(spot.db_name), spot)
+            _persist_hindcast(spot, key, data)
+        for old_key in [k for k in _HINDCAST_STORE if k[:2] == key[:2]]:
+            del _HINDCAST_STORE[old_key]
+        _HINDCAST_STORE[key] = data
+    return _HINDCAST_STORE[key]
+
+
+def _persisted_hindcast_file(spot) -> Path:
+    return Path(HINDCAST_STORE_DIR) / f"hindcast_{spot.db_name}_{spot.name}.pkl"
+
+
+def _load_persisted_hindcast(spot, key):
+    if HINDCAST_STORE_DIR is None or not _persisted_hindcast_file(spot).is_file():
+        return None
+    with open(_persisted_hindcast_file(spot), 'rb') as f:
+        stored_key, data = pickle.load(f)
+    return data if stored_key == key else None
+
+
+def _persist_hindcast(spot, key, data):
+    if HINDCAST_STORE_DIR is None:
+        return
+    Path(HINDCAST_STORE_DIR).mkdir(parents=True, exist_ok=True)
+    with open(_persisted_hindcast_file(spot), 'wb') as f:
+        pickle.dump((key, data), f)
+
+
 @dataclass
 class SpotInfo:
     pier: int
@@ -111,15 +202,13 @@ class Spot:
             return all
 
     def _hindcast_input(self):
-        """Surf historical statistics"""
-        data = stormglass.load_data(self.db_name)
-        data = enrich_input_data(data, self)
-        return data
+        """Surf historical statistics (shared, cached frame: copy before modifying)"""
+        return enriched_hindcast(self)
 
 
     def training_data(self, only_spot_data, non_zero_only=True, match_all_feedback_times=True, fb_columns: str=None, pim=False):
         """Combined surf statistics and feedback form"""
-        hindcast = deepcopy(self._hindcast_input())
+        hindcast = self._hindcast_input().copy()
         feedback = self.feedback(only_spot_data=only_spot_data)
 
         if not fb_columns:
@@ -128,29 +217,14 @@ class Spot:
         self.add_spot_info(hindcast)
 
         # Combine feedback with hindcast
-        for index, row in feedback.iterrows():
-            pattern = r'^\d{2}:\d{2}:\d{2}$'
-            datum = row["Datum"]
-            date_wrong_format = not re.match(pattern, str(row['Start tijd'])) or not re.match(pattern,
-                                                                                              str(row['Eind tijd']))
-
-            if date_wrong_format:
-                continue
-            start_tijd = datetime.datetime.strptime(f"{datum} {row['Start tijd']}", "%d-%m-%Y %H:%M:%S")
-            eind_tijd = datetime.datetime.strptime(f"{datum} {row['Eind tijd']}", "%d-%m-%Y %H:%M:%S")
-            if not match_all_feedback_times:
-                mid_tijd = start_tijd + ((eind_tijd - start_tijd) / 2)
-                start_tijd = mid_tijd - datetime.timedelta(minutes=5)
-                eind_tijd = mid_tijd + datetime.timedelta(minutes=5)
-            cet = pytz.timezone("Europe/Amsterdam")
-            start_tijd = cet.localize(start_tijd)
-            eind_tijd = cet.localize(eind_tijd)
-            # todo remove all timezone shit
-
-            query = (hindcast.index >= start_tijd) & (hindcast.index <= eind_tijd)
-            # if all(query == False):
-            #     continue
-            hindcast.loc[query, fb_columns] = row[fb_columns]
+        feedback, start_tijd, eind_tijd = feedback_intervals(feedback, match_all_feedback_times)
+        hindcast_tijd = pd.DatetimeIndex(pd.to_datetime(hindcast.index, utc=True)).asi8
+        owner = match_feedback(hindcast_tijd, start_tijd, eind_tijd)
+        matched = np.flatnonzero(owner >= 0)
+        columns = [fb_columns] if isinstance(fb_columns, str) else list(fb_columns)
+        for column in columns:
+            values = pd.Series(feedback[column].to_numpy()[owner[matched]]).infer_objects().to_numpy()
+            hindcast.iloc[matched, hindcast.columns.get_loc(column)] = values
 
         assert len(hindcast) > 0, "No hindcast data"
         if non_zero_only:
@@ -170,13 +244,22 @@ class Spot:
         result = model.model.predict(data)
         return result
 
-    def surf_rating(self, models, cache=False):
-        data_init = self.forecast(cache)
-
-        data = deepcopy(data_init)
+    def predict_surf_perks(self, data, models) -> pd.DataFrame:
+        """Rate the surf forecast with all models, the input data is enriched only once"""
+        features = enrich_input_data(data.copy(deep=False), self)
+        columns = list(dict.fromkeys(channel for model in models for channel in model.channels))
+        position = {column: i for i, column in enumerate(columns)}
+        X = features[columns].to_numpy(dtype=np.float32)
+        predictions = {}
         for model in models:
-            data[model.perk] = self.predict_surf_perk(data_init, model)
-        return data
+            predictions[model.perk] = model.predict(X[:, [position[c] for c in model.channels]])
+        return pd.DataFrame(predictions, index=data.index)
+
+    def surf_rating(self, models, cache=False, data_init=None):
+        """Forecast including a column per model perk. Pass data_init to rate an already downloaded forecast."""
+        if data_init is None:
+            data_init = self.forecast(cache)
+        return pd.concat([data_init, self.predict_surf_perks(data_init, models)], axis=1)
 
     def add_spot_info(self, data):
         # Add pier data
@@ -201,6 +284,17 @@ texel_paal17 = Spot(richting=305, name="Texel17", lat=53.081695, long=4.733450,
 # spots = [ijmuiden, scheveningen, camperduin, texel_paal17]
 SPOTS = [schev, NW, ZV, ijmuiden, wijk, camperduin, texel_paal17]
 
+# All spots are on the Dutch coast, so the timezone polygons never have to be loaded for them
+for _spot in SPOTS:
+    stormglass.register_timezone(_spot.lat, _spot.long, "Europe/Amsterdam")
+
+
+def forecast_spots(spots, cache=False, hours=24*7):
+    """Download the forecast of all spots concurrently, returns dict of spot name -> DataFrame or exception"""
+    points = {spot.name: (spot.lat, spot.long) for spot in spots}
+    return stormglass.fetch_forecasts(points, hours=hours, cache=cache)
+
+
 def find_spot(name: str) -> Spot:
     for spot in SPOTS:
         if spot.name.lower() in name.lower(): # todo  This may produce wrong matches (e.g., "Schev" matches "Schev_N" and "Schev_Z").
@@ -1,14 +1,19 @@
+import asyncio
+import hashlib
+import os
 from pathlib import Path
 import pandas as pd
 import numpy as np
 import arrow
 import requests
 import json
-from tabulate import tabulate
-from matplotlib import pyplot as plt
 from datetime import datetime
 import pytz
-from random import randrange
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache, partial
+from threading import Lock
+from requests.adapters import HTTPAdapter
 from timezonefinder import TimezoneFinder
 
 
@@ -26,6 +31,24 @@ keys = [
 ]
 N_KEYS = len(keys)
 
+API_URL = os.getenv('STORMGLASS_API_URL', 'https://api.stormglass.io/v2')  # override to use a local stub/replay server
+REQUEST_TIMEOUT = 30  # seconds per HTTP request
+MAX_RETRIES = 3  # retries of a request on rate limiting (429), server errors (5xx) or connection errors
+RETRY_BACKOFF = 1.0  # seconds, doubled after every retry
+RETRY_STATUS = {429, 500, 502, 503, 504}
+QUOTA_STATUS = {402}  # daily quota of the key is used up
+MAX_WORKERS = 8  # concurrent HTTP requests when fetching several points
+GRID_RESOLUTION = 0.25  # degrees, points within the same cell share one request
+MAX_REQUEST_DAYS = 10  # longest time range of a single API request
+BACKFILL_WORKERS = 2  # concurrent requests when downloading historical data
+TIMEZONE_DECIMALS = 2  # lat/long rounding for timezone lookups (~1 km)
+
+RESPONSE_CACHE_DIR = Path(os.getenv('STORMGLASS_CACHE_DIR', Path(__file__).resolve().parent / 'stormglass' / 'responses'))
+RESPONSE_CACHE_TTL = 60 * 60 * 6  # seconds, the forecast models behind the API update every 6 hours
+RESPONSE_CACHE_MAX_FILES = 256  # least recently used responses are removed above this
+CACHE_DECIMALS = 4  # lat/long rounding in the response cache key (~10 m)
+RECORD_DIR = os.getenv('STORMGLASS_RECORD_DIR')  # save every API response here for stormglass_replay, None to disable
+FORECAST_UPDATE_HOURS = 6  # forecast windows are aligned on this, so refreshes in between request the same window
 
 
 data_sources = {"waveDirection": "icon",
@@ -42,65 +65,239 @@ data_sources = {"waveDirection": "icon",
                 }
 
 
-# Get first hour of today
-def download_json(lat, long, start, end, cache=False, end_point="weather"):
-  response_type = end_point
-  if "/" in response_type:
-        response_type = end_point.replace("/", "_")
-  cache_file = Path(f'stormglass/stormglass_response_{response_type}_{lat}_{long}.json')
-
-  if cache_file.is_file() and cache:
+KNOWN_TIMEZONES = {}  # rounded (lat, long) -> timezone name, filled with register_timezone
+_timezone_finder = None
+_timezone_lock = Lock()
+
+
+def _round_point(lat, long):
+    return round(lat, TIMEZONE_DECIMALS), round(long, TIMEZONE_DECIMALS)
+
+
+def register_timezone(lat, long, timezone):
+    """Precompute the timezone of a point so it is never looked up with TimezoneFinder"""
+    KNOWN_TIMEZONES[_round_point(lat, long)] = timezone
+
+
+@lru_cache(maxsize=256)
+def _timezone_at(lat, long):
+    global _timezone_finder
+    if (lat, long) in KNOWN_TIMEZONES:
+        return KNOWN_TIMEZONES[(lat, long)]
+    with _timezone_lock:  # building the finder loads its polygon data, do it once and only when needed
+        if _timezone_finder is None:
+            _timezone_finder = TimezoneFinder()
+        return _timezone_finder.timezone_at(lat=lat, lng=long)
+
+
+def timezone_at(lat, long):
+    """Timezone name of a point, cached per rounded coordinate"""
+    return _timezone_at(*_round_point(lat, long))
+
+
+class StormglassClient:
+    """
+        Stormglass API client with one keep-alive session shared by all threads
+
+    Keys are used round-robin. A key whose daily quota is used up (quota status, or 'requestCount' reaching
+    'dailyQuota' in the response meta) is skipped until the next UTC day. Rate limiting, server errors and connection
+    errors are retried with exponential backoff on the next key.
+    """
+
+    def __init__(self, api_keys=keys, url=API_URL, max_retries=MAX_RETRIES, backoff=RETRY_BACKOFF):
+        self.keys = list(api_keys)
+        self.url = url
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS))
+        self.quota = {}  # key -> remaining requests today according to the last response meta
+        self._exhausted = {}  # key -> UTC date on which its quota was used up
+        self._i_next = 0
+        self._lock = Lock()
+
+    def next_key(self):
+        """Next key in turn that still has quota today"""
+        today = datetime.utcnow().date()
+        with self._lock:
+            for _ in range(len(self.keys)):
+                key = self.keys[self._i_next]
+                self._i_next = (self._i_next + 1) % len(self.keys)
+                if self._exhausted.get(key) != today:
+                    return key
+        raise FileNotFoundError('All Stormglass API keys have used up their daily quota')
+
+    def _update_quota(self, key, meta):
+        with self._lock:
+            if 'dailyQuota' in meta and 'requestCount' in meta:
+                self.quota[key] = meta['dailyQuota'] - meta['requestCount']
+                if self.quota[key] <= 0:
+                    self._exhausted[key] = datetime.utcnow().date()
+
+    def _set_exhausted(self, key):
+        with self._lock:
+            self.quota[key] = 0
+            self._exhausted[key] = datetime.utcnow().date()
+
+    def get_json(self, end_point, params, timeout=REQUEST_TIMEOUT):
+        """GET {url}/{end_point}/point and return the decoded json"""
+        return self.fetch(end_point, params, timeout=timeout)[1]
+
+    def fetch(self, end_point, params, timeout=REQUEST_TIMEOUT, headers=None):
+        """GET {url}/{end_point}/point, returns the response and its decoded json (None for 304 Not Modified)"""
+        attempt = 0
+        while True:
+            key = self.next_key()
+            try:
+                response = self.session.get(f'{self.url}/{end_point}/point', params=params,
+                                            headers={**(headers or {}), 'Authorization': key}, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+            else:
+                if response.status_code in QUOTA_STATUS:
+                    self._set_exhausted(key)
+                    continue  # next key, next_key() raises once all keys are exhausted
+                if response.status_code == 304:
+                    return response, None
+                if response.status_code not in RETRY_STATUS:
+                    json_data = response.json()
+                    self._update_quota(key, json_data.get('meta', {}))
+                    return response, json_data
+                if attempt >= self.max_retries:
+                    raise FileNotFoundError(f'Stormglass API request failed with status {response.status_code}')
+                retry_after = response.headers.get('Retry-After', '')
+                delay = int(retry_after) if retry_after.isdigit() else self.backoff * 2 ** attempt
+            print(f"Retrying {end_point} in {delay:.0f}s")
+            time.sleep(delay)
+            attempt += 1
+
+
+_client = None
+_client_lock = Lock()
+
+
+def get_client():
+    """Process wide Stormglass client, created on first use"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = StormglassClient()
+        return _client
+
+
+def response_cache_file(end_point, params) -> Path:
+    """Cache file of an API response, keyed on the end point, the rounded coordinates and the other parameters"""
+    key = {**params, 'lat': round(params['lat'], CACHE_DECIMALS), 'lng': round(params['lng'], CACHE_DECIMALS)}
+    digest = hashlib.sha1(json.dumps([end_point, key], sort_keys=True).encode()).hexdigest()[:20]
+    return RESPONSE_CACHE_DIR / f"{end_point.replace('/', '_')}_{digest}.json"
+
+
+def _read_cached_response(file: Path):
+    """Cached entry {'time', 'validators', 'data'}, or None"""
+    try:
+        with open(file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_cached_response(file: Path, json_data, validators):
+    file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = file.with_suffix(f'.tmp{os.getpid()}')
+    with open(tmp_file, 'w') as f:
+        json.dump({'time': time.time(), 'validators': validators, 'data': json_data}, f)
+    os.replace(tmp_file, file)
+    evict_cached_responses()
+
+
+def evict_cached_responses(max_files=RESPONSE_CACHE_MAX_FILES):
+    """Remove the least recently used responses above max_files"""
+    files = []
+    for file in RESPONSE_CACHE_DIR.glob('*.json'):
+        try:
+            files.append((file.stat().st_mtime, file))
+        except FileNotFoundError:  # removed by another process
+            pass
+    for _, file in sorted(files, reverse=True)[max_files:]:
+        file.unlink(missing_ok=True)
+
+
+def record_response(end_point, params, json_data, record_dir):
+    """Save an API response with its request parameters, to be replayed by stormglass_replay"""
+    record_dir = Path(record_dir)
+    record_dir.mkdir(parents=True, exist_ok=True)
+    file = record_dir / f"{end_point.replace('/', '_')}_{params['lat']:.4f}_{params['lng']:.4f}_{int(params['start'])}.json"
+    with open(file, 'w') as f:
+        json.dump({'end_point': end_point, 'params': params, 'data': json_data}, f)
+
+
+def download_json(lat, long, start, end, cache=False, end_point="weather", timeout=REQUEST_TIMEOUT,
+                  ttl=RESPONSE_CACHE_TTL):
+  """
+      Stormglass API response for one point and time range
+
+  Every response is cached in RESPONSE_CACHE_DIR. With cache=True a cached response younger than ttl seconds is
+  returned without an API call, an older one is revalidated with its ETag/Last-Modified. cache=False always requests.
+  """
+  params = {
+      'lat': lat,
+      'lng': long,
+      'start': start.to('UTC').timestamp(),  # Convert to UTC timestamp
+      'end': end.to('UTC').timestamp()  # Convert to UTC timestamp
+  }
+  if end_point == "weather":
+      params['params'] = ','.join(channels)
+  cache_file = response_cache_file(end_point, params)
+
+  entry = _read_cached_response(cache_file) if cache else None
+  if entry is not None and time.time() - entry['time'] < ttl:
     print(f"cashing {end_point} from {start} to {end}")
-    with open(cache_file, 'r') as f:
-      json_data = json.load(f)
+    os.utime(cache_file)  # mark as recently used
+    return entry['data']
+
+  print(f"Scraping {end_point} from {start} to {end}")
+  validators = entry['validators'] if entry is not None else {}
+  conditional_headers = {}
+  if 'ETag' in validators:
+      conditional_headers['If-None-Match'] = validators['ETag']
+  if 'Last-Modified' in validators:
+      conditional_headers['If-Modified-Since'] = validators['Last-Modified']
+  response, json_data = get_client().fetch(end_point, params, timeout=timeout, headers=conditional_headers)
+  if json_data is None:  # 304 Not Modified
+      json_data = entry['data']
   else:
-    print(f"Scraping {end_point} from {start} to {end}")
-    params = {
-        'lat': lat,
-        'lng': long,
-        'start': start.to('UTC').timestamp(),  # Convert to UTC timestamp
-        'end': end.to('UTC').timestamp()  # Convert to UTC timestamp
-    }
-    if end_point == "weather":
-        params['params'] = ','.join(channels)
-
-    i_key = randrange(N_KEYS)
-    response = requests.get(
-      f'https://api.stormglass.io/v2/{end_point}/point',
-      params=params,
-      headers={
-        'Authorization': keys[i_key]
-      }
-    )
-
-
-    json_data = response.json()
-    if "errors" in json_data:
-        raise FileNotFoundError(json_data["errors"]["key"])
-    with open(cache_file, 'w') as f:
-      json.dump(json_data, f)  # dumps response from API in response.json (cache_file)
-
+      validators = {h: response.headers[h] for h in ('ETag', 'Last-Modified') if h in response.headers}
+  if "errors" in json_data:
+      raise FileNotFoundError(json_data["errors"]["key"])
+  _write_cached_response(cache_file, json_data, validators)
+  if RECORD_DIR is not None:
+      record_response(end_point, params, json_data, RECORD_DIR)
   return json_data
 
+
 def json_to_df(json_data, best_sg_source, lat, long):
-  hourly_data = {}
   if 'hours' not in json_data:
       raise FileNotFoundError('Something went wrong with the stormglass API request')
-
-  for entry in json_data['hours']:
-      name = entry['time']
-      hourly_data[name] = {}
-      for channel in channels:
-            source = "sg" if best_sg_source else data_sources[channel]
-            assert channel in entry, f"channel {channel} not in entry"
-            assert source in entry[channel], f"source '{source}' not in {entry[channel]} for channel '{channel}'"
-            hourly_data[name][channel] = entry[channel][source]
-
-  # Create a Pandas DataFrame
-  df = pd.DataFrame.from_dict(hourly_data, orient='index')
-  df.index = pd.to_datetime(df.index)
-  timezone = TimezoneFinder().timezone_at(lat=lat, lng=long)
-  df.index = df.index.tz_convert(pytz.timezone(timezone))
+  hours = json_data['hours']
+
+  # Columnar decoding: one array per channel, validated per channel instead of per cell
+  columns = {}
+  for channel in channels:
+      source = "sg" if best_sg_source else data_sources[channel]
+      try:
+          columns[channel] = np.array([entry[channel][source] for entry in hours], dtype=float)
+      except KeyError:
+          entry = next(entry for entry in hours if channel not in entry or source not in entry[channel])
+          assert channel in entry, f"channel {channel} not in entry"
+          assert source in entry[channel], f"source '{source}' not in {entry[channel]} for channel '{channel}'"
+          raise
+
+  index = pd.to_datetime([entry['time'] for entry in hours], utc=True, format="ISO8601")
+  df = pd.DataFrame(columns, index=index)
+  df.index = df.index.tz_convert(pytz.timezone(timezone_at(lat, long)))
   return df
 
 
@@ -118,108 +315,410 @@ def download_tide(lat, long, start, end, cache=False):
     df = pd.DataFrame(data_list)
     df["time"] = pd.to_datetime(df["time"])
     df.set_index("time", inplace=True)
-    timezone = TimezoneFinder().timezone_at(lat=lat, lng=long)
-    df.index = df.index.tz_convert(pytz.timezone(timezone))
+    df.index = df.index.tz_convert(pytz.timezone(timezone_at(lat, long)))
     df.columns = ["NAP"]
     return df
 
 
+async def _in_thread(pool, func, *args, **kwargs):
+    """Run a blocking download on pool (None for the default executor) without blocking the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(pool, partial(func, *args, **kwargs))
+
+
+def _run(coroutine):
+    """Run a coroutine from synchronous code, also when called from a running event loop (Jupyter, async views)"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    # asyncio.run cannot be nested: run the coroutine on its own loop in a helper thread
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coroutine).result()
+
+
+async def download_weather_and_tide_async(lat, long, start, end, cache=False, pool=None):
+    """Weather and tide of one point, both end points are requested concurrently"""
+    data_new, data_tide = await asyncio.gather(
+        _in_thread(pool, download_weather, lat, long, start, end, cache=cache, best_sg_source=True),
+        _in_thread(pool, download_tide, lat, long, start, end, cache=cache),
+    )
+    return pd.concat([data_new, data_tide], axis=1)
+
+
 def download_weather_and_tide(lat, long, start, end, cache=False):
-    data_new = download_weather(lat, long, start, end, cache=cache, best_sg_source=True)
-    data_tide = download_tide(lat, long, start, end, cache=cache)
-    data_new = pd.concat([data_new, data_tide], axis=1)
-    return data_new
+    return _run(download_weather_and_tide_async(lat, long, start, end, cache=cache))
+
 
 def download_and_save_data(name, lat, long, start, end, cache=False):
     data_new = download_weather_and_tide(lat, long, start, end, cache=cache)
     append_historical_data(name, lat, long, data_new)
     return data_new
 
-def load_data(name: str):
-    file = Path(f'stormglass/data_{name}.pkl')
-    if file.is_file():
+def data_file(name: str) -> Path:
+    """Legacy pickle with all historical data, superseded by the partitioned store (store_dir)"""
+    return Path(f'stormglass/data_{name}.pkl')
+
+
+def store_dir(name: str) -> Path:
+    """Historical data store: one parquet file per month (UTC), indexed on time in UTC"""
+    return Path(f'stormglass/data_{name}')
+
+
+def _partition_file(name: str, month: str) -> Path:
+    return store_dir(name) / f"{month}.parquet"
+
+
+def _partition_files(name: str, start=None, end=None):
+    """Partition files sorted on time, only the months overlapping start-end if given"""
+    files = sorted(store_dir(name).glob("*.parquet"))
+    if start is not None:
+        files = [f for f in files if f.stem >= _to_utc(start).strftime("%Y-%m")]
+    if end is not None:
+        files = [f for f in files if f.stem <= _to_utc(end).strftime("%Y-%m")]
+    return files
+
+
+def _to_utc(time) -> pd.Timestamp:
+    if isinstance(time, arrow.Arrow):
+        time = time.datetime
+    time = pd.Timestamp(time)
+    return time.tz_localize("UTC") if time.tz is None else time.tz_convert("UTC")
+
+
+def _utc_index(data: pd.DataFrame) -> pd.DataFrame:
+    data = data.copy(deep=False)
+    data.index = pd.DatetimeIndex(pd.to_datetime(data.index, utc=True), name="time")
+    return data
+
+
+def data_mtime(name: str):
+    """Modification time (ns) of the stored historical data, None if nothing is stored"""
+    if store_dir(name).is_dir():
+        files = [store_dir(name)] + _partition_files(name)
+        return max(f.stat().st_mtime_ns for f in files)
+    file = data_file(name)
+    return file.stat().st_mtime_ns if file.is_file() else None
+
+
+def load_data(name: str, columns=None, start=None, end=None):
+    """Historical data, optionally only the given columns and the time range start-end (inclusive)
+
+    Only the partitions overlapping the time range are read. Falls back to the legacy pickle when there is no store.
+    """
+    if store_dir(name).is_dir():
+        frames = [pd.read_parquet(f, columns=columns) for f in _partition_files(name, start, end)]
+        data_db = pd.concat(frames) if frames else pd.DataFrame(columns=columns)
+    else:
+        file = data_file(name)
+        if not file.is_file():
+            return pd.DataFrame()
         data_db = pd.read_pickle(file)
+        if columns is not None:
+            data_db = data_db[columns]
+        if start is None and end is None:
+            return data_db
+        data_db = _utc_index(data_db).sort_index(kind="stable")
+
+    # The index is sorted, so the range is found with a binary search
+    lo = data_db.index.searchsorted(_to_utc(start), side="left") if start is not None else 0
+    hi = data_db.index.searchsorted(_to_utc(end), side="right") if end is not None else len(data_db)
+    return data_db.iloc[lo:hi]
+
+
+def data_range(name: str):
+    """First and last time in the stored data, (None, None) if nothing is stored"""
+    if store_dir(name).is_dir():
+        files = _partition_files(name)
+        if not files:
+            return None, None
+        first = pd.read_parquet(files[0], columns=[]).index
+        last = pd.read_parquet(files[-1], columns=[]).index
+        return first.min(), last.max()
+    data_db = load_data(name)
+    if len(data_db) == 0:
+        return None, None
+    index = pd.to_datetime(data_db.index, utc=True)
+    return index.min(), index.max()
+
+
+def _merge(data_db: pd.DataFrame, data_new: pd.DataFrame, policy: str) -> pd.DataFrame:
+    if policy == "last":
+        merged = pd.concat([data_db[~data_db.index.isin(data_new.index)], data_new], axis=0)
+    elif policy == "non_null":
+        merged = data_new.combine_first(data_db)
+        merged = merged[list(dict.fromkeys([*data_db.columns, *data_new.columns]))]
     else:
-        data_db = pd.DataFrame()
-    return data_db
-
-def append_historical_data(name, lat, long, data_new):
-    """Only function with writing acces"""
-    file = Path(f'stormglass/data_{name}.pkl')
+        raise ValueError(f"Unknown policy: {policy}")
+    return merged.sort_index(kind="stable")
+
+
+def upsert_historical_data(name: str, data_new: pd.DataFrame, policy="last"):
+    """Merge data into the store on its time index, returns the number of rows inserted and replaced
+
+    :param policy: "last" to replace stored rows with new rows for the same time, "non_null" to only overwrite stored
+        values with values in the new rows that are not missing
+
+    Only the months present in data_new are rewritten. Every partition is kept sorted and free of duplicate times.
+    """
+    store_dir(name).mkdir(parents=True, exist_ok=True)
+    data_new = _utc_index(data_new)
+    data_new = data_new[~data_new.index.duplicated(keep="last")]
+    inserted = replaced = 0
+    for month, data_month in data_new.groupby(data_new.index.strftime("%Y-%m")):
+        file = _partition_file(name, month)
+        if file.is_file():
+            data_db = pd.read_parquet(file)
+            data_db = data_db[~data_db.index.duplicated(keep="last")]
+        else:
+            data_db = data_month.iloc[:0]
+        n_replaced = int(data_month.index.isin(data_db.index).sum())
+        replaced += n_replaced
+        inserted += len(data_month) - n_replaced
+        tmp_file = file.with_suffix(".parquet.tmp")
+        _merge(data_db, data_month, policy).to_parquet(tmp_file)
+        os.replace(tmp_file, file)
+    return inserted, replaced
+
+
+def convert_to_store(name: str):
+    """Move the legacy pickle into the partitioned store (the pickle itself is kept)"""
+    if store_dir(name).is_dir() or not data_file(name).is_file():
+        return
+    upsert_historical_data(name, pd.read_pickle(data_file(name)))
+
+
+def incomplete_file(name: str) -> Path:
+    """Hours downloaded with missing values, which are not stored (see append_historical_data)"""
+    return Path(f'stormglass/data_{name}_incomplete.parquet')
+
+
+def incomplete_hours(name: str) -> pd.DatetimeIndex:
+    """Hours (UTC) that were downloaded but not stored because a value was missing at the source"""
+    file = incomplete_file(name)
+    if not file.is_file():
+        return pd.DatetimeIndex([], tz="UTC", name="time")
+    return pd.read_parquet(file).index
+
+
+def _record_incomplete_hours(name: str, hours, stored_hours):
+    hours = incomplete_hours(name).union(_utc_index(pd.DataFrame(index=hours)).index)
+    hours = hours.difference(_utc_index(pd.DataFrame(index=stored_hours)).index)
+    file = incomplete_file(name)
+    file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = file.with_suffix(".parquet.tmp")
+    pd.DataFrame(index=hours).to_parquet(tmp_file)
+    os.replace(tmp_file, file)
+
+
+def append_historical_data(name, lat, long, data_new, policy="last"):
+    """Only function with writing acces
+
+    Only complete hours are stored. The hours with missing values are recorded (see incomplete_hours), so a backfill
+    does not request them again.
+    """
+    convert_to_store(name)
     now = datetime.now()
-    data_db = load_data(name)
     tz = data_new.index.tz
     now_pd = pd.to_datetime(now, utc=tz)
     data_new_historical = data_new[data_new.index <= now_pd]
-    data_new_historical = data_new_historical.dropna()
-    data_total = pd.concat([data_db, data_new_historical], axis=0)
-    if len(data_new) > 0:  # save data
-        data_total.to_pickle(file)
+    data_complete = data_new_historical.dropna()
+    if len(data_complete) > 0:  # save data
+        inserted, replaced = upsert_historical_data(name, data_complete, policy=policy)
+        print(f"Stored {name}: {inserted} hours inserted, {replaced} replaced")
+    if len(data_complete) < len(data_new_historical):
+        incomplete = data_new_historical.index.difference(data_complete.index)
+        _record_incomplete_hours(name, incomplete, data_complete.index)
+        print(f"Not stored {name}: {len(incomplete)} hours with missing values")
     return data_new
 
 
-def smart_data(name, lat, long, start, end, cache=False):
-    data_db = load_data(name)
-    start_in_df = arrow.get(data_db.index.min()) <= start
-    end_in_df = arrow.get(data_db.index.max()) >= end
-    request_is_fully_in_df = start_in_df and end_in_df
+def missing_intervals(index, start, end, freq="H"):
+    """Time ranges (UTC, inclusive) of the hours between start and end that are not in index"""
+    expected = pd.date_range(_to_utc(start).ceil(freq), _to_utc(end).floor(freq), freq=freq)
+    missing = expected[~expected.isin(pd.to_datetime(index, utc=True))]
+    if len(missing) == 0:
+        return []
+    step = pd.Timedelta(1, unit=freq).value
+    breaks = np.flatnonzero(np.diff(missing.asi8) != step)
+    starts = missing[np.r_[0, breaks + 1]]
+    ends = missing[np.r_[breaks, len(missing) - 1]]
+    return list(zip(starts, ends))
+
+
+def split_interval(start, end, max_days=MAX_REQUEST_DAYS, freq="H"):
+    """Split a time range in chunks that fit in a single API request"""
+    chunks = []
+    chunk_start = start
+    while chunk_start <= end:
+        chunk_end = min(chunk_start + pd.Timedelta(days=max_days) - pd.Timedelta(1, unit=freq), end)
+        chunks.append((chunk_start, chunk_end))
+        chunk_start = chunk_end + pd.Timedelta(1, unit=freq)
+    return chunks
+
+
+def plan_backfill(name, start, end, max_days=MAX_REQUEST_DAYS):
+    """Requests needed to fill the gaps in the stored data between start and end, hours known to be incomplete at the
+    source are not requested again"""
+    index = load_data(name, columns=[], start=start, end=end).index.union(incomplete_hours(name))
+    return [chunk for gap in missing_intervals(index, start, end) for chunk in split_interval(*gap, max_days=max_days)]
+
+
+def backfill(name, lat, long, start, end, cache=False, max_workers=BACKFILL_WORKERS):
+    """Download only the missing historical hours between start and end, returns the number of requests done
+
+    Chunks are downloaded in parallel (at most max_workers at a time to respect the API quota) and stored as soon as
+    they arrive, so a backfill that stopped halfway continues where it left off when run again. On an API error the
+    remaining chunks are cancelled and the error is raised.
+    """
+    end = min(_to_utc(end), _to_utc(arrow.utcnow()))  # future hours are never stored
+    plan = plan_backfill(name, start, end)
+    if not plan:
+        print(f"{name}: no missing data")
+        return 0
+    print(f"{name}: backfilling {len(plan)} chunks")
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        jobs = [pool.submit(download_weather_and_tide, lat, long, arrow.get(a), arrow.get(b), cache=cache)
+                for a, b in plan]
+        try:
+            for job in as_completed(jobs):
+                append_historical_data(name, lat, long, job.result())
+        except Exception:
+            pool.shutdown(wait=True, cancel_futures=True)
+            raise
+    return len(plan)
 
-    if request_is_fully_in_df:
-        print("Data solely from database")
-        result = data_db
-    else:
-        data_new = download_weather_and_tide(lat, long, start, end, cache=cache)
-        result = append_historical_data(name, lat, long, data_new)
 
-    #Requested time range of the data
-    tz = result.index.tz
-    start_pd = pd.to_datetime(start.datetime, utc=tz)
-    end_pd = pd.to_datetime(end.datetime, utc=tz)
-    result_range = result[(result.index >=start_pd) & (result.index <= end_pd)]
-    return result_range
+def smart_data(name, lat, long, start, end, cache=False):
+    """Historical data between start and end, downloads only the hours that are not stored yet
+
+    The result comes from the store: hours after now and hours with missing values are not included (before the
+    store, the downloaded data was returned as is, including those hours).
+    """
+    backfill(name, lat, long, start, end, cache=cache)
+    return load_data(name, start=start, end=end)
 
 
 def append_x_days_back(name, lat, long, days: float, cache=False):
-    data = load_data(name)
-    if len(data) > 0:
-        oldest = arrow.get(min(data.index))
+    first, _ = data_range(name)
+    if first is not None:
+        oldest = arrow.get(first)
     else:
         oldest = arrow.now('Europe/Amsterdam')
     new_oldest = oldest.shift(days=-days)
-    return download_and_save_data(lat, long, new_oldest, oldest, cache=cache)
+    return download_and_save_data(name, lat, long, new_oldest, oldest, cache=cache)
 
 def append_x_days_upfront(name, lat, long, days: float, cache=False):
-    data = load_data(name)
-    if len(data) > 0:
-        oldest = arrow.get(max(data.index))
+    _, last = data_range(name)
+    if last is not None:
+        oldest = arrow.get(last)
     else:
         oldest = arrow.now('Europe/Amsterdam')
     new_oldest = oldest.shift(days=days)
     return download_and_save_data(name, lat, long, oldest,new_oldest, cache=cache)
 
 
+def forecast_window(hours):
+    """Time range to request for a forecast of hours from now
+
+    The range starts at the beginning of the current FORECAST_UPDATE_HOURS block (UTC), so every refresh within a
+    block requests the same range and can be served from the response cache. Use trim_forecast on the result.
+    """
+    now = arrow.utcnow()
+    start = now.floor('hour').shift(hours=-(now.hour % FORECAST_UPDATE_HOURS))
+    end = start.shift(hours=hours + FORECAST_UPDATE_HOURS)
+    return start.to('Europe/Amsterdam'), end.to('Europe/Amsterdam')
+
+
+def trim_forecast(data, hours):
+    """Only the hours from the current hour up to hours from now"""
+    now = pd.Timestamp.now(tz='UTC')
+    return data[(data.index >= now.floor('H')) & (data.index <= now + pd.Timedelta(hours=hours))]
+
+
 def forecast(lat, long, hours, cache=False):
-    now = arrow.now('Europe/Amsterdam')
-    start = now.shift(hours=0)
-    end = now.shift(hours=hours)
+    start, end = forecast_window(hours)
     data_new = download_weather_and_tide(lat, long, start, end, cache=cache)
-    return data_new
-
-def keep_scraping_untill_error(name, back=False):
-    while True:
-        try:
-            if back:
-                append_x_days_back(name, lat, long, 10, cache=False)
-            else:
-                append_x_days_upfront(name, lat, long, 10, cache=False)
-        except FileNotFoundError as e:
-            print(e)
-            df = load_data(name)
-            break
-    return df
+    return trim_forecast(data_new, hours)
+
+
+def grid_cell(lat, long, resolution=GRID_RESOLUTION):
+    return round(lat / resolution), round(long / resolution)
+
+
+def plan_requests(points, resolution=GRID_RESOLUTION):
+    """Group points that share a model grid cell
+
+    :param points: dict of key -> (lat, long)
+    :return: dict of canonical (lat, long) -> list of keys using it
+
+    The canonical point of a cell is the first point that falls in it, so the request is always done on a location
+    that is known to have sea data. Use resolution=None to request every point separately.
+    """
+    canonical = {}
+    plan = {}
+    for key, (lat, long) in points.items():
+        cell = grid_cell(lat, long, resolution) if resolution else (lat, long)
+        point = canonical.setdefault(cell, (lat, long))
+        plan.setdefault(point, []).append(key)
+    return plan
+
+
+async def fetch_forecasts_async(points, hours, cache=False, max_workers=MAX_WORKERS, resolution=GRID_RESOLUTION):
+    """Download the forecast for several points concurrently.
+
+    :param points: dict of key -> (lat, long)
+    :return: dict of key -> DataFrame, or the exception raised while fetching that point
+
+    Points sharing a grid cell are fetched once (see plan_requests). Weather and tide of every distinct point are
+    all requested at the same time (at most max_workers HTTP requests in flight), so the total time is roughly that
+    of the slowest request. A failing point does not affect the others.
+    """
+    start, end = forecast_window(hours)
+    plan = plan_requests(points, resolution)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        datas = await asyncio.gather(
+            *(download_weather_and_tide_async(lat, long, start, end, cache=cache, pool=pool) for lat, long in plan),
+            return_exceptions=True,
+        )
+    results = {}
+    for point, data in zip(plan, datas):
+        if not isinstance(data, Exception):
+            data = trim_forecast(data, hours)
+        for key in plan[point]:
+            results[key] = data if isinstance(data, Exception) else data.copy()
+    return {key: results[key] for key in points}
+
+
+def fetch_forecasts(points, hours, cache=False, max_workers=MAX_WORKERS, resolution=GRID_RESOLUTION):
+    """Synchronous fetch_forecasts_async"""
+    return _run(fetch_forecasts_async(points, hours, cache=cache, max_workers=max_workers, resolution=resolution))
+
+
+def keep_scraping_untill_error(name, lat, long, back=False):
+    """Fill up the data from the last stored hour until now, or (back) keep extending it backwards until an API error"""
+    try:
+        if back:
+            first, _ = data_range(name)
+            while True:
+                oldest = arrow.get(first) if first is not None else arrow.utcnow()
+                backfill(name, lat, long, oldest.shift(days=-MAX_REQUEST_DAYS * BACKFILL_WORKERS), oldest)
+                first_new, _ = data_range(name)
+                if first_new == first:  # nothing older available
+                    break
+                first = first_new
+        else:
+            _, last = data_range(name)
+            now = arrow.utcnow()
+            backfill(name, lat, long, arrow.get(last) if last is not None else now.shift(days=-MAX_REQUEST_DAYS), now)
+    except FileNotFoundError as e:
+        print(e)
+    return load_data(name)
 
 
 if __name__ == '__main__':
+    from matplotlib import pyplot as plt
+    from tabulate import tabulate
+
     name = "ZV"
     lat = 52.474773
     long = 4.535204
@@ -229,7 +728,7 @@ if __name__ == '__main__':
     cache=False
 
     # df = append_x_days_upfront(lat, long, 10, cache=cache)
-    df = keep_scraping_untill_error(name, back=False)
+    df = keep_scraping_untill_error(name, lat, long, back=False)
     # df = smart_data(name, lat, long, start, end, cache=cache)
 
     # df = load_data(lat, long)
@@ -0,0 +1,188 @@
+"""
+Offline stand-in for the Stormglass API, replaying responses recorded with stormglass.RECORD_DIR.
+
+Record:     STORMGLASS_RECORD_DIR=stormglass/recordings python web_update_silent.py
+Replay:     python stormglass_replay.py [recordings dir]
+            starts a replay server and benchmarks site refreshes against it. Any other process can use the server
+            with STORMGLASS_API_URL=http://127.0.0.1:<port>
+
+The recorded responses are shifted in time to the requested start, so a recording keeps working as a forecast.
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+RECORDINGS_DIR = Path(__file__).resolve().parent / 'stormglass' / 'recordings'
+REPLAY_PORT = 8765
+
+
+def load_recordings(record_dir=RECORDINGS_DIR):
+    """Recorded responses per end point: dict of end point -> list of (params, data)"""
+    recordings = {}
+    for file in sorted(Path(record_dir).glob('*.json')):
+        with open(file, 'r') as f:
+            recording = json.load(f)
+        recordings.setdefault(recording['end_point'], []).append((recording['params'], recording['data']))
+    return recordings
+
+
+def _hour(timestamp):
+    return int(float(timestamp)) // 3600 * 3600
+
+
+def shift_times(json_data, seconds):
+    """Copy of a response with the 'time' of every hour (weather) or data point (tide) shifted"""
+    def shift(entry):
+        t = datetime.fromisoformat(entry['time']).timestamp() + seconds
+        return {**entry, 'time': datetime.fromtimestamp(t, timezone.utc).isoformat()}
+
+    shifted = dict(json_data)
+    for key in ('hours', 'data'):
+        if key in shifted:
+            shifted[key] = [shift(entry) for entry in shifted[key]]
+    return shifted
+
+
+class ReplayServer:
+    """
+        Local HTTP server answering /{end point}/point requests from recordings
+
+    :param recordings: see load_recordings
+    :param latency: seconds added to every response, plus a random 0-jitter seconds
+    :param error_rate: fraction of the requests answered with one of error_statuses instead
+    :param seed: seed of the latency jitter and error injection, for reproducible runs
+
+    The response of the recording closest to the requested point is returned, shifted in time so it starts at the
+    requested start.
+    """
+
+    def __init__(self, recordings, latency=0.0, jitter=0.0, error_rate=0.0, error_statuses=(503,), port=0, seed=None):
+        self.recordings = recordings
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses
+        self.n_requests = 0
+        self.n_errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._server.server_port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def response(self, end_point, params):
+        """Status and json of the replayed response"""
+        with self._lock:
+            self.n_requests += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            failed = self._random.random() < self.error_rate
+            status = self._random.choice(self.error_statuses) if failed else 200
+            self.n_errors += failed
+        time.sleep(delay)
+        if failed:
+            return status, {'errors': {'key': f'Injected error {status}'}}
+        if end_point not in self.recordings:
+            return 404, {'errors': {'key': f'No recording of {end_point}'}}
+        lat, lng = float(params['lat']), float(params['lng'])
+        recorded_params, data = min(self.recordings[end_point],
+                                    key=lambda r: (r[0]['lat'] - lat) ** 2 + (r[0]['lng'] - lng) ** 2)
+        return 200, shift_times(data, _hour(params['start']) - _hour(recorded_params['start']))
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                end_point = url.path.strip('/').removesuffix('/point')
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                status, json_data = server.response(end_point, params)
+                body = json.dumps(json_data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def benchmark(refresh, runs=10):
+    """Run refresh() runs times, returns throughput and latency percentiles in seconds"""
+    durations = []
+    errors = 0
+    for _ in range(runs):
+        t_start = time.perf_counter()
+        try:
+            refresh()
+        except Exception as e:
+            errors += 1
+            print(f"Refresh failed: {e}")
+        durations.append(time.perf_counter() - t_start)
+    durations = np.array(durations)
+    return {
+        'runs': runs,
+        'errors': errors,
+        'throughput': runs / durations.sum(),
+        'p50': np.percentile(durations, 50),
+        'p95': np.percentile(durations, 95),
+        'p99': np.percentile(durations, 99),
+        'max': durations.max(),
+    }
+
+
+if __name__ == '__main__':
+    record_dir = sys.argv[1] if len(sys.argv) > 1 else RECORDINGS_DIR
+    latency = 0.3  # seconds, typical Stormglass response time
+    jitter = 0.5
+    error_rate = 0.05
+    runs = 10
+
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import stormglass
+    with ReplayServer(load_recordings(record_dir), latency=latency, jitter=jitter, error_rate=error_rate,
+                      error_statuses=(429, 503), port=REPLAY_PORT, seed=0) as server:
+        stormglass.get_client().url = server.url
+        from web_update_silent import generate_site_content
+
+        def refresh():
+            # a fresh response cache per run, so every refresh goes through the (replayed) API
+            with tempfile.TemporaryDirectory() as cache_dir:
+                stormglass.RESPONSE_CACHE_DIR = Path(cache_dir)
+                generate_site_content()
+
+        stats = benchmark(refresh, runs=runs)
+        print(f"{server.n_requests} requests, {server.n_errors} injected errors")
+        print(", ".join(f"{key}: {value:.3f}" for key, value in stats.items()))
@@ -11,133 +11,457 @@ from matplotlib import pyplot as plt
 from data.models import MODELS
 from plotting import plot_forecast, save_to_web, plot_all
 import webtables
-from spots import SPOTS, texel_paal17, ijmuiden, ZV, schev, NW
+from spots import SPOTS, texel_paal17, ijmuiden, ZV, schev, NW, forecast_spots
+from stormglass import FORECAST_UPDATE_HOURS
 from tabulate import tabulate
 import pandas as pd
+import gzip
 import json
 import pickle
-import threading
 import time
+from datetime import datetime, timedelta, timezone
 
-CACHE_MAX_AGE_SECONDS = 60 * 60 * 8  # 8 hours
-_CACHE_LOCK = threading.Lock()
+try:
+	import brotli  # optional, pages are also stored brotli compressed when it is installed
+except ImportError:
+	brotli = None
+
+CACHE_MAX_AGE_SECONDS = 60 * 60 * 8  # 8 hours, content older than this is refreshed when the refresh worker starts
+REFRESH_INTERVAL_HOURS = FORECAST_UPDATE_HOURS  # the refresh worker runs when the forecast models update (UTC)
+REFRESH_DELAY_MINUTES = 30  # after the model update, to give the API time to publish it
+REFRESH_MIN_AGE_SECONDS = 60 * 15  # spots refreshed less than this ago are not refreshed again by a scheduled run
+RETRY_FAILED_MINUTES = 10  # failed spots are retried after this, instead of at the next forecast model update
+N_HOURS_AV = 3  # hours averaged before taking the daily aggregates of the week overview
 _CACHE_STATE_FILE = Path(__file__).resolve().parent / 'site_cache_state.json'
-_CACHE_CONTENT_FILE = Path(__file__).resolve().parent / 'site_cache_content.pkl'
+SITE_CACHE_DIR = Path(__file__).resolve().parent / 'site_cache'  # content snapshots and the CURRENT pointer
+KEEP_GENERATIONS = 5  # published snapshots kept for rollback
+_REFRESH_LEASE_FILE = Path(__file__).resolve().parent / 'site_cache_refresh.lease'
+REFRESH_LEASE_SECONDS = 60 * 30  # a lease older than this is from a crashed refresh and is taken over
+METRICS_KEEP_SECONDS = 60 * 60 * 24 * 7  # counters of processes that saved nothing for this long are removed
+_OBSOLETE_STATE_KEYS = ('last_update_ts', 'metrics', 'pid')  # removed from the state file, no longer used
+
+
+def spot_content(spot, data):
+	"""Table, widget and daily aggregates (for the week overview) of one spot"""
+	daily = pd.DataFrame({
+		"rating": data["rating"].rolling(N_HOURS_AV).mean().resample('D').max(),
+		"hoogte-v2": data["hoogte-v2"].rolling(N_HOURS_AV).mean().resample('D').mean(),
+	})
+	return {
+		"table": webtables.table_per_day(data, spot, webtables.table_html),
+		"widget": webtables.table_html_simple(data, spot),
+		"daily": daily,
+		"updated": time.time(),
+	}
+
+
+def week_overview_html(dailies, today=None):
+	"""Week overview table from the daily aggregates per spot name (see spot_content)
+
+	Spots refreshed at different times cover different days: only the days from today on are shown.
+	"""
+	names = list(dailies)
+	rating = pd.concat([daily["rating"] for daily in dailies.values()], axis=1, keys=names)
+	hoogte = pd.concat([daily["hoogte-v2"] for daily in dailies.values()], axis=1, keys=names)
+	today = today or pd.Timestamp.now(tz=rating.index.tz).normalize()
+	days = rating.index[rating.index >= today]
+	rating, hoogte = rating.loc[days], hoogte.loc[days]
+	html = webtables.head
+	html += "<table>\n<tr>\n<th></th>\n" + "".join(f"<th>{n}</th>\n" for n in names) + "</tr>\n"
+	for (index, row_rating), (_, row_hoogte) in zip(rating.iterrows(), hoogte.iterrows()):
+		html += "<tr>\n"
+		html += f"\t<td>{index.strftime('%A, %d-%m')}</td>\n"
+		for name in names:
+			color = webtables.get_color(row_rating[name])
+			hv = webtables.height_label(row_hoogte[name], simple=True) if row_hoogte[name] > 0 else "geen data"
+			color_bar = f"<div class='rounded-span'  style='background-color: {color}'></div>"
+			value = "-" if pd.isna(row_rating[name]) else f"{row_rating[name]:.1f}"
+			html += f"\t<td style='text-align: left;'>{color_bar} <h3>{value}</h3> {hv}</td>\n"
+		html += "</tr>\n"
+	html += "</table>\n"
+	return html
+
+
+def encode_page(html):
+	"""html as utf-8 bytes per content coding it can be served with: identity, gzip and br (if brotli is installed)"""
+	body = html.encode()
+	encoded = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+	if brotli is not None:
+		encoded['br'] = brotli.compress(body)
+	return encoded
 
 
-def generate_site_content():
+def site_pages(content):
+	"""Encoded pages of content (see encode_page): the embedded page and the plain (?plain=1) html of the week overview
+	and spot tables, the embedded page of the spot widgets"""
+	def variants(html, plain=True):
+		pages = {'embed': encode_page(webtables.embed_page(html))}
+		if plain:
+			pages['plain'] = encode_page(webtables.plain_html(html))
+		return pages
+
+	return {
+		'week_overview': variants(content['week_overview']),
+		'spot_tables': {name: variants(html) for name, html in content['spot_tables'].items()},
+		'spot_widgets': {name: variants(html, plain=False) for name, html in content['spot_widgets'].items()},
+	}
+
+
+def generate_site_content(previous=None, stale_before=None):
 	"""Generate HTML content for the website without writing to disk.
 
+	Only the spots that are missing from previous (earlier content) or were updated before the stale_before
+	timestamp are recomputed, all spots if stale_before is None. A spot that fails keeps its previous content, so
+	it neither blocks nor invalidates the others.
+
 	Returns a dict with keys:
-	- 'week_overview': str
+	- 'week_overview': str, reassembled from the daily aggregates of all spots
 	- 'spot_tables': Dict[spot_name, str]
 	- 'spot_widgets': Dict[spot_name, str]
+	- 'pages': the pages served by the forecast views, rendered and compressed once, see site_pages
+	- 'spots': Dict[spot_name, dict], see spot_content
+	- 'refreshed': List[spot_name] recomputed by this call
+	- 'failed': Dict[spot_name, str] error of the spots that failed in this call
 	"""
-	# Ensure relative cache paths used by stormglass resolve under the data folder
-	data_dir = Path(__file__).resolve().parent
-	old_cwd = Path.cwd()
-	os.chdir(data_dir)
+	previous_spots = (previous or {}).get('spots', {})
+	spots = {spot.name: previous_spots[spot.name] for spot in SPOTS if spot.name in previous_spots}
+	stale = [spot for spot in SPOTS
+			 if stale_before is None or spot.name not in spots or spots[spot.name]['updated'] < stale_before]
+	failed = {}
+	# Responses younger than the forecast update interval come from the stormglass response cache.
+	# All stale spots are downloaded concurrently.
+	forecasts = forecast_spots(stale, cache=True) if stale else {}
+	for spot in stale:
+		try:
+			if isinstance(forecasts[spot.name], Exception):
+				raise forecasts[spot.name]
+			data = spot.surf_rating(models=MODELS, data_init=forecasts[spot.name])
+			spots[spot.name] = spot_content(spot, data)
+		except Exception as e:
+			print(f"Keeping the previous content of {spot.name}: refresh failed ({e})")
+			failed[spot.name] = str(e)
+	if not spots:
+		raise FileNotFoundError(f"No spot could be refreshed: {failed}")
+	spots = {spot.name: spots[spot.name] for spot in SPOTS if spot.name in spots}  # in the order of SPOTS
+
+	content = {
+		"week_overview": week_overview_html({name: content["daily"] for name, content in spots.items()}),
+		"spot_tables": {name: content["table"] for name, content in spots.items()},
+		"spot_widgets": {name: content["widget"] for name, content in spots.items()},
+	}
+	return {
+		**content,
+		"pages": site_pages(content),
+		"spots": spots,
+		"refreshed": [spot.name for spot in stale if spot.name not in failed],
+		"failed": failed,
+	}
+
+
+# Content of this process and the version of the cache file it was loaded from: (version, content)
+_MEMORY_CACHE = (None, None)
+# Refresh counters of this process, published in the state file per pid, see refresh_metrics
+_REFRESH_METRICS = {
+	'started': 0,  # refreshes started
+	'skipped_leased': 0,  # refreshes not done because another process holds the lease
+	'skipped_fresh': 0,  # refreshes not done because the content was refreshed recently
+	'completed': 0,
+	'failed': 0,  # refreshes that published nothing because every stale spot failed
+	'spots_refreshed': 0,
+	'spots_failed': 0,
+}
+
+
+def _current_file():
+	return SITE_CACHE_DIR / 'CURRENT'
+
+
+def _snapshot_file(generation):
+	return SITE_CACHE_DIR / f'content_{generation:06d}.pkl'
+
+
+def _generations():
+	"""Generations of the stored snapshots, oldest first"""
+	return sorted(int(file.stem.split('_')[1]) for file in SITE_CACHE_DIR.glob('content_*.pkl'))
+
+
+def _write_atomic(file, write, mode='w'):
+	"""Write to a temp file and rename, so readers see either the old or the new file, never a partial one"""
+	tmp_file = file.with_name(f'.{file.name}.tmp{os.getpid()}')
+	with open(tmp_file, mode) as f:
+		write(f)
+	os.replace(tmp_file, file)
+
+
+def _read_current():
+	"""The published snapshot {'generation', 'published'}, None if nothing is published yet"""
 	try:
-		# Ensure stormglass cache directory exists
-		(data_dir / 'stormglass').mkdir(exist_ok=True)
-		datas = []
-		spot_tables = {}
-		spot_widgets = {}
-		for spot in SPOTS:
-			# Never use spot.surf_rating(cache=True); always compute fresh
-			data = spot.surf_rating(cache=False, models=MODELS)
-			data.name = spot.name
-			datas.append(data)
-			spot_tables[spot.name] = webtables.table_per_day(data, spot, webtables.table_html)
-			spot_widgets[spot.name] = webtables.table_html_simple(data, spot)
-
-		# Build week overview HTML (webtables.weekoverzicht writes to disk), so emulate here
-		n_hours_av = 3
-		datas_daily = [spot_df.rolling(n_hours_av).mean().resample('D').max() for spot_df in datas]
-		for data_daily, data in zip(datas_daily, datas):
-			data_daily["hoogte-v2"] = data["hoogte-v2"].rolling(n_hours_av).mean().resample('D').mean()
-		names = [spot_df.name for spot_df in datas]
-		rating = pd.concat([spot_df["rating"] for spot_df in datas_daily], axis=1, keys=names)
-		hoogte = pd.concat([spot_df["hoogte-v2"] for spot_df in datas_daily], axis=1, keys=names)
-		html = webtables.head
-		html += "<table>\n<tr>\n<th></th>\n" + "".join(f"<th>{n}</th>\n" for n in names) + "</tr>\n"
-		for (index, row_rating), (_, row_hoogte) in zip(rating.iterrows(), hoogte.iterrows()):
-			html += "<tr>\n"
-			html += f"\t<td>{index.strftime('%A, %d-%m')}</td>\n"
-			for name in names:
-				color = webtables.get_color(row_rating[name])
-				hv = webtables.height_label(row_hoogte[name], simple=True) if row_hoogte[name] > 0 else "geen data"
-				color_bar = f"<div class='rounded-span'  style='background-color: {color}'></div>"
-				html += f"\t<td style='text-align: left;'>{color_bar} <h3>{row_rating[name]:.1f}</h3> {hv}</td>\n"
-			html += "</tr>\n"
-		html += "</table>\n"
-
-		return {
-			"week_overview": html,
-			"spot_tables": spot_tables,
-			"spot_widgets": spot_widgets,
-		}
-	finally:
-		os.chdir(old_cwd)
+		with open(_current_file(), 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return None
 
 
-def _load_cached_content():
-	if _CACHE_CONTENT_FILE.is_file():
-		with open(_CACHE_CONTENT_FILE, 'rb') as f:
-			return pickle.load(f)
+def _content_version():
+	"""Identity of the CURRENT pointer file, None if there is none. Changes whenever a snapshot is published."""
+	try:
+		stat = os.stat(_current_file())
+	except FileNotFoundError:
+		return None
+	return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _content_age():
+	current = _read_current()
+	return None if current is None else time.time() - current['published']
+
+
+def _load_current_content():
+	for _ in range(3):
+		current = _read_current()
+		if current is None:
+			return None
+		try:
+			with open(_snapshot_file(current['generation']), 'rb') as f:
+				content = pickle.load(f)
+		except FileNotFoundError:  # pruned after a newer publish, read the new pointer
+			continue
+		if 'pages' not in content:  # published before the pages were stored in the snapshot
+			content['pages'] = site_pages(content)
+		return content
 	return None
 
 
-def _save_cached_content(content):
-	with open(_CACHE_CONTENT_FILE, 'wb') as f:
-		pickle.dump(content, f)
+def _set_current(generation, published):
+	_write_atomic(_current_file(), lambda f: json.dump({'generation': generation, 'published': published}, f))
+
+
+def publish_site_content(content):
+	"""Store content as a new snapshot generation and make it the current one, returns the generation"""
+	SITE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+	generation = max(_generations(), default=0) + 1
+	published = time.time()
+	content = {**content, 'generation': generation, 'published': published}  # for the HTTP cache validators
+	_write_atomic(_snapshot_file(generation), lambda f: pickle.dump(content, f, protocol=pickle.HIGHEST_PROTOCOL),
+				  mode='wb')
+	_set_current(generation, published)
+	for old in _generations()[:-KEEP_GENERATIONS]:
+		_snapshot_file(old).unlink(missing_ok=True)
+	return generation
+
 
+def rollback_site_content(generation=None):
+	"""Make an older snapshot current again (default: the one before the current), returns its generation"""
+	current = _read_current()
+	older = [g for g in _generations() if current is None or g < current['generation']]
+	if generation is None:
+		if not older:
+			raise ValueError("No older site content generation to roll back to")
+		generation = older[-1]
+	if not _snapshot_file(generation).is_file():
+		raise ValueError(f"Site content generation {generation} is not available, kept: {_generations()}")
+	with open(_snapshot_file(generation), 'rb') as f:
+		published = pickle.load(f).get('published', os.stat(_snapshot_file(generation)).st_mtime)
+	_set_current(generation, published)
+	return generation
 
-def _get_last_update_ts():
-	if _CACHE_STATE_FILE.is_file():
+
+def _load_state():
+	try:
 		with open(_CACHE_STATE_FILE, 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return {}
+
+
+def _save_state(**state):
+	state = {**_load_state(), **state}
+	for key in _OBSOLETE_STATE_KEYS:
+		state.pop(key, None)
+	_write_atomic(_CACHE_STATE_FILE, lambda f: json.dump(state, f))
+
+
+def _save_metrics():
+	"""Store the counters of this process next to those of the other processes, see refresh_metrics"""
+	now = time.time()
+	workers = {pid: metrics for pid, metrics in _load_state().get('workers', {}).items()
+			   if now - metrics['saved'] < METRICS_KEEP_SECONDS}
+	workers[str(os.getpid())] = {**_REFRESH_METRICS, 'saved': now}
+	_save_state(workers=workers)
+
+
+def _read_lease():
+	try:
+		with open(_REFRESH_LEASE_FILE, 'r') as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return None
+
+
+def _acquire_refresh_lease():
+	"""Take the refresh lease shared by all processes, False if another process holds it"""
+	for _ in range(2):
+		try:
+			fd = os.open(_REFRESH_LEASE_FILE, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+		except FileExistsError:
 			try:
-				state = json.load(f)
-				return float(state.get('last_update_ts', 0))
-			except Exception:
-				return 0.0
-	return 0.0
+				expired = time.time() - os.stat(_REFRESH_LEASE_FILE).st_mtime > REFRESH_LEASE_SECONDS
+			except FileNotFoundError:  # released in the meantime
+				continue
+			if not expired:
+				return False
+			_take_over_expired_lease()
+			continue
+		with os.fdopen(fd, 'w') as f:
+			json.dump({'pid': os.getpid(), 'since': time.time()}, f)
+		return True
+	return False
 
 
-def _set_last_update_ts(ts: float):
-	with open(_CACHE_STATE_FILE, 'w') as f:
-		json.dump({'last_update_ts': ts}, f)
+def _take_over_expired_lease():
+	"""Move an expired lease out of the way. The rename is atomic, so of the processes that found the lease expired
+	only one removes it, the others then compete for the new lease (O_EXCL)."""
+	stale = _REFRESH_LEASE_FILE.with_name(f"{_REFRESH_LEASE_FILE.name}.{os.getpid()}.stale")
+	try:
+		os.rename(_REFRESH_LEASE_FILE, stale)
+	except FileNotFoundError:  # taken over or released by another process
+		return
+	try:
+		if time.time() - os.stat(stale).st_mtime <= REFRESH_LEASE_SECONDS:
+			# renamed the lease another process took over since the expiry check: give it back
+			os.link(stale, _REFRESH_LEASE_FILE)
+	except FileExistsError:
+		pass
+	finally:
+		os.remove(stale)
 
 
-def _refresh_cache_background():
+def _release_refresh_lease():
+	"""Remove the lease if this process holds it, it may have been taken over after expiring"""
+	lease = _read_lease()
+	if lease is None or lease.get('pid') != os.getpid():
+		return
 	try:
-		content = generate_site_content()
-		_save_cached_content(content)
-		_set_last_update_ts(time.time())
-	except Exception:
-		# best-effort; keep old cache on error
+		os.remove(_REFRESH_LEASE_FILE)
+	except FileNotFoundError:
 		pass
 
 
+def refresh_site_content(min_age=REFRESH_MIN_AGE_SECONDS):
+	"""Recompute the spots updated more than min_age seconds ago (or failed) and publish the result for the web workers
+
+	Single-flight: skipped when another process holds the refresh lease.
+	Returns the names of the spots refreshed and a dict of spot name -> error of the spots that failed.
+	"""
+	if not _acquire_refresh_lease():
+		_REFRESH_METRICS['skipped_leased'] += 1
+		_save_metrics()
+		return [], {}
+	try:
+		previous = _load_current_content()
+		stale_before = time.time() - min_age
+		previous_spots = (previous or {}).get('spots', {})
+		if all(spot.name in previous_spots and previous_spots[spot.name]['updated'] >= stale_before for spot in SPOTS):
+			_REFRESH_METRICS['skipped_fresh'] += 1
+			return [], {}
+		_REFRESH_METRICS['started'] += 1
+		t_start = time.time()
+		try:
+			content = generate_site_content(previous, stale_before=stale_before)
+		except Exception:
+			_REFRESH_METRICS['failed'] += 1
+			raise
+		_REFRESH_METRICS['spots_refreshed'] += len(content['refreshed'])
+		_REFRESH_METRICS['spots_failed'] += len(content['failed'])
+		if content['refreshed']:
+			generation = publish_site_content(content)
+			_save_state(last_generation=generation, last_duration_seconds=time.time() - t_start,
+						spots_updated={name: spot['updated'] for name, spot in content['spots'].items()})
+		_REFRESH_METRICS['completed'] += 1
+		return content['refreshed'], content['failed']
+	finally:
+		_release_refresh_lease()
+		_save_metrics()
+
+
+def next_refresh_time(now=None, interval_hours=REFRESH_INTERVAL_HOURS, delay_minutes=REFRESH_DELAY_MINUTES):
+	"""First forecast model update (every interval_hours from 00:00 UTC) plus delay_minutes after now"""
+	now = now or datetime.now(timezone.utc)
+	day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+	delay = timedelta(minutes=delay_minutes)
+	n_intervals = int((now - day - delay) // timedelta(hours=interval_hours)) + 1
+	return day + n_intervals * timedelta(hours=interval_hours) + delay
+
+
+def content_max_age(content, now=None, pending_max_age=60):
+	"""Seconds that clients may cache content: until the refresh worker will replace it, briefly if that is due
+
+	Content with failed spots is replaced by the retry of those spots (RETRY_FAILED_MINUTES), other content by the
+	first scheduled refresh that finds a spot stale (REFRESH_MIN_AGE_SECONDS), see run_refresh_worker.
+	"""
+	now = now or datetime.now(timezone.utc)
+	published = content.get('published', 0)
+	if content.get('failed'):
+		due = datetime.fromtimestamp(published, timezone.utc) + timedelta(minutes=RETRY_FAILED_MINUTES)
+	else:
+		oldest = min((spot['updated'] for spot in content.get('spots', {}).values()), default=published)
+		due = next_refresh_time(datetime.fromtimestamp(oldest + REFRESH_MIN_AGE_SECONDS, timezone.utc))
+	if due <= now:
+		return pending_max_age  # the refresh worker is (re)computing the content
+	return max(pending_max_age, int((due - now).total_seconds()))
+
+
+def run_refresh_worker(once=False):
+	"""Refresh the site content now if it is stale, then at every forecast model update"""
+	min_age = CACHE_MAX_AGE_SECONDS
+	while True:
+		try:
+			refreshed, failed = refresh_site_content(min_age=min_age)
+			print(f"Site content refreshed for {refreshed or 'no spots'}, failed for {list(failed)}: {_REFRESH_METRICS}")
+		except Exception as e:
+			# every stale spot failed, e.g. a cold start while the API is down: retry soon as well
+			failed = {'*': str(e)}
+			print(f"Site content refresh failed, keeping the old content: {e}")
+		if once:
+			return
+		min_age = REFRESH_MIN_AGE_SECONDS
+		next_time = next_refresh_time()
+		if failed:
+			# only the failed spots are stale for the retry, the others were just refreshed
+			next_time = min(next_time, datetime.now(timezone.utc) + timedelta(minutes=RETRY_FAILED_MINUTES))
+		print(f"Next refresh at {next_time:%Y-%m-%d %H:%M} UTC")
+		time.sleep(max(0.0, (next_time - datetime.now(timezone.utc)).total_seconds()))
+
+
+def refresh_metrics():
+	"""Counters of the refresh workers, the age of the published content and the holder of the refresh lease
+
+	'metrics' adds up the counters of all processes, 'workers' has them per pid.
+	"""
+	state = _load_state()
+	workers = state.get('workers', {}).values()
+	return {
+		**state,
+		'metrics': {key: sum(metrics.get(key, 0) for metrics in workers) for key in _REFRESH_METRICS},
+		'current': _read_current(),
+		'content_age_seconds': _content_age(),
+		'lease': _read_lease(),
+	}
+
+
 def get_cached_site_content():
-	"""Return cached content; if older than 8h, trigger background refresh.
+	"""Return the content published by the refresh worker, None if it has not published anything yet.
 
-	If no cache exists yet, compute synchronously once and save.
+	Web workers never generate content themselves (see run_refresh_worker). The content stays in memory and is
+	only reloaded when a new snapshot is published (one stat per call), so the cost of a call does not depend on
+	the content size. Snapshots are immutable and published by an atomic rename, so no lock is needed.
 	"""
-	with _CACHE_LOCK:
-		last_ts = _get_last_update_ts()
-		age = time.time() - last_ts
-		content = _load_cached_content()
-		if content is None:
-			# First-time compute synchronously
-			content = generate_site_content()
-			_save_cached_content(content)
-			_set_last_update_ts(time.time())
-			return content
-		if age > CACHE_MAX_AGE_SECONDS:
-			# kick off background refresh if not already running
-			threading.Thread(target=_refresh_cache_background, daemon=True).start()
-		return content
+	global _MEMORY_CACHE
+	version = _content_version()
+	if _MEMORY_CACHE[0] != version:
+		_MEMORY_CACHE = (version, _load_current_content())
+	return _MEMORY_CACHE[1]
+
 
 if __name__ == '__main__':
 	# Preserve legacy behavior: generate and write outputs
@@ -1,3 +1,4 @@
+import re
 from datetime import timezone, timedelta
 from math import radians, cos, sin, floor, ceil
 from typing import List
@@ -43,9 +44,6 @@ def get_color(rating: float) -> str:
 
 head = """
 <head>
-<meta http-equiv="Cache-Control" content="no-cache, no-store, must-revalidate" />
-<meta http-equiv="Pragma" content="no-cache" />
-<meta http-equiv="Expires" content="0" />
 <meta name="viewport" content="width=device-width, initial-scale=1">
 <style>
     table {
@@ -114,6 +112,27 @@ head = """
 </head>
 """
 
+embed_head = """<!DOCTYPE html>
+<html>
+<head>
+	<meta name="viewport" content="width=device-width, initial-scale=1">
+</head>
+<body>
+"""
+
+
+def embed_page(html: str) -> str:
+    """Complete page embedding a table (served by the forecast views)"""
+    return f"{embed_head}{html}\n</body>\n</html>\n"
+
+
+def plain_html(html: str) -> str:
+    """Table html without <head> and <body> tags, to be inserted into another page (?plain=1)"""
+    html = re.sub(r"<head[\s\S]*?</head>", "", html, flags=re.IGNORECASE)
+    html = re.sub(r"</?body[^>]*>", "", html, flags=re.IGNORECASE)
+    return html.strip()
+
+
 def round_off_rating(number):
     return min(10, max(1, number))
     # return round(number * 2) / 2
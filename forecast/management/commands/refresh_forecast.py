@@ -0,0 +1,28 @@
+import sys
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+# Ensure the project's root and data folder are on sys.path so data.* modules import correctly (as in views.py)
+PROJECT_ROOT = Path(__file__).resolve().parents[3]
+for path in (PROJECT_ROOT, PROJECT_ROOT / 'data'):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
+
+from data.web_update_silent import run_refresh_worker, rollback_site_content
+
+
+class Command(BaseCommand):
+    help = "Regenerate the forecast site content at every forecast model update (or once with --once)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Refresh if the content is stale and exit")
+        parser.add_argument('--rollback', nargs='?', type=int, const=0, metavar='GENERATION',
+                            help="Publish an older content generation again (default: the previous one) and exit")
+
+    def handle(self, *args, once=False, rollback=None, **options):
+        if rollback is not None:
+            generation = rollback_site_content(rollback or None)
+            self.stdout.write(f"Site content rolled back to generation {generation}")
+            return
+        run_refresh_worker(once=once)
@@ -7,6 +7,7 @@ urlpatterns = [
     path('spot/<str:spot_name>/', views.spot_table, name='spot_table'),
     path('widget/<str:spot_name>/', views.spot_widget, name='spot_widget'),
     path('health/', views.health_check, name='health_check'),
+    path('health/cache/', views.cache_status, name='cache_status'),
 ]
 
 
@@ -1,7 +1,9 @@
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, Http404, JsonResponse
 from django.shortcuts import render
-from django.utils.safestring import mark_safe
-import re
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition
+from datetime import datetime, timezone
+from functools import wraps
 
 import os
 import sys
@@ -19,7 +21,7 @@ if str(DATA_DIR) not in sys.path:
 from data.spots import SPOTS
 from data.webtables import weekoverzicht, table_per_day, table_html, table_html_simple
 from data.models import MODELS
-from data.web_update_silent import get_cached_site_content
+from data.web_update_silent import get_cached_site_content, refresh_metrics, content_max_age
 
 
 def _get_spot_by_name(spot_name: str):
@@ -29,53 +31,128 @@ def _get_spot_by_name(spot_name: str):
     return None
 
 
+def _content(request):
+    """Site content for this request, read once so the validators and the body belong to the same generation"""
+    if not hasattr(request, '_forecast_content'):
+        request._forecast_content = get_cached_site_content()
+    return request._forecast_content
+
+
+def _variant(request):
+    return 'plain' if request.GET.get('plain') == '1' else 'embed'
+
+
+def _content_coding(request, encoded):
+    """Content coding of encoded (coding -> bytes) to serve: br, else gzip, if the client accepts it"""
+    accepted = set()
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        coding, *params = [part.strip() for part in item.split(';')]
+        q = next((param[2:] for param in params if param.startswith('q=')), '1')
+        try:
+            if float(q) > 0:
+                accepted.add(coding.lower())
+        except ValueError:
+            pass
+    for coding in ('br', 'gzip'):
+        if coding in accepted and coding in encoded:
+            return coding
+    return 'identity'
+
+
+def _content_etag(request, *args, **kwargs):
+    content = _content(request)
+    if content is None or 'generation' not in content:
+        return None
+    coding = _content_coding(request, content['pages']['week_overview']['embed'])  # all pages have the same codings
+    # generations are numbered from 1 again on a new deploy (empty site cache), the publish time tells them apart
+    version = f"{content['generation']}.{int(content.get('published', 0))}"
+    return f"{version}-{_variant(request)}" + ('' if coding == 'identity' else f"-{coding}")
+
+
+def _content_last_modified(request, *args, **kwargs):
+    content = _content(request)
+    if content is None or 'published' not in content:
+        return None
+    return datetime.fromtimestamp(content['published'], timezone.utc)
+
+
+def _forecast_cache(view):
+    """Conditional GET (ETag from the content generation, Last-Modified) and caching until the next refresh"""
+    conditional_view = condition(etag_func=_content_etag, last_modified_func=_content_last_modified)(view)
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = conditional_view(request, *args, **kwargs)
+        content = _content(request)
+        if response.status_code in (200, 304) and content is not None:
+            patch_cache_control(response, public=True, max_age=content_max_age(content))
+        patch_vary_headers(response, ('Accept-Encoding',))  # the ETag and body depend on the content coding
+        return response
+    return wrapper
+
+
 def home(request):
     return render(request, 'forecast/home.html', {})
 
 
+def _page_response(request, page):
+    """Serve the stored bytes of a page (see web_update_silent.site_pages) in the coding the client accepts"""
+    encoded = page.get(_variant(request), page['embed'])
+    coding = _content_coding(request, encoded)
+    response = HttpResponse(encoded[coding], content_type='text/html; charset=utf-8')
+    if coding != 'identity':
+        response['Content-Encoding'] = coding
+    return response
+
+
+def _forecast_unavailable():
+    """The refresh worker has not published any content yet"""
+    response = HttpResponse("De verwachting wordt bijgewerkt, probeer het over een minuut opnieuw.", status=503)
+    response['Retry-After'] = '60'
+    return response
+
+
+@_forecast_cache
 def week_overview(request):
-    content = get_cached_site_content()
-    html = content['week_overview']
-    if request.GET.get('plain') == '1':
-        html = _sanitize_embedded_html(html)
-        return HttpResponse(html)
-    return render(request, 'forecast/embed.html', { 'content': mark_safe(html) })
+    content = _content(request)
+    if content is None:
+        return _forecast_unavailable()
+    return _page_response(request, content['pages']['week_overview'])
 
 
+@_forecast_cache
 def spot_table(request, spot_name: str):
-    content = get_cached_site_content()
+    content = _content(request)
+    if content is None:
+        return _forecast_unavailable()
     if spot_name not in content['spot_tables']:
         spot = _get_spot_by_name(spot_name)
         if spot is None:
             raise Http404("Spot not found")
-    html = content['spot_tables'].get(spot_name)
-    if request.GET.get('plain') == '1':
-        html = _sanitize_embedded_html(html)
-        return HttpResponse(html)
-    return render(request, 'forecast/embed.html', { 'content': mark_safe(html) })
+        return _forecast_unavailable()  # no refresh of this spot succeeded yet
+    return _page_response(request, content['pages']['spot_tables'][spot_name])
 
 
+@_forecast_cache
 def spot_widget(request, spot_name: str):
-    content = get_cached_site_content()
+    content = _content(request)
+    if content is None:
+        return _forecast_unavailable()
     if spot_name not in content['spot_widgets']:
         spot = _get_spot_by_name(spot_name)
         if spot is None:
             raise Http404("Spot not found")
-    html = content['spot_widgets'].get(spot_name)
-    return render(request, 'forecast/embed.html', { 'content': mark_safe(html) })
-
-
-def _sanitize_embedded_html(html: str) -> str:
-    # Remove <head>...</head>
-    html = re.sub(r"<head[\s\S]*?</head>", "", html, flags=re.IGNORECASE)
-    # Remove wrapping <body> tags
-    html = re.sub(r"</?body[^>]*>", "", html, flags=re.IGNORECASE)
-    # Trim stray whitespace
-    return html.strip()
+        return _forecast_unavailable()  # no refresh of this spot succeeded yet
+    return _page_response(request, content['pages']['spot_widgets'][spot_name])
 
 
 def health_check(request):
     """Health check endpoint for monitoring"""
     return HttpResponse("OK", status=200)
 
+
+def cache_status(request):
+    """Site content refresh metrics of the refresh worker"""
+    return JsonResponse(refresh_metrics())
+
 # Create your views here.
@@ -9,5 +9,8 @@ python manage.py migrate --noinput
 # Collect static files
 python manage.py collectstatic --noinput
 
+# Start the refresh worker, the web workers only serve the content it publishes
+python manage.py refresh_forecast &
+
 # Start the application
 exec gunicorn mswsite.wsgi:application --bind 0.0.0.0:$PORT --workers 3
@@ -47,6 +47,7 @@ from django.test import TestCase
 # Import project modules
 from data.spots import Spot, SpotInfo, SPOTS, find_spot
 from data.models import Model, MODELS
+import xgboost  # data.models imports xgboost lazily; load it before open() is mocked by the fixtures below
 from data.surffeedback import load, rename_columns, text_to_value
 from data.plotting import angle_to_direction, index_interval
 from data.webtables import get_color, height_label, round_off_rating
@@ -23,8 +23,8 @@ class TestSystemIntegration:
 
         # Mock the download_weather_and_tide function that forecast calls
         with patch('data.stormglass.download_weather_and_tide') as mock_download:
-            # Create realistic forecast data
-            dates = pd.date_range(start='2024-01-01', periods=24, freq='H')
+            # Create realistic forecast data, starting at the current hour
+            dates = pd.date_range(start=pd.Timestamp.now(tz='UTC').floor('H'), periods=24, freq='H')
             forecast_data = pd.DataFrame({
                 'waveHeight': np.random.uniform(0.5, 3.0, 24),
                 'wavePeriod': np.random.uniform(4.0, 12.0, 24),
@@ -6,7 +6,7 @@ import pandas as pd
 import numpy as np
 from unittest.mock import Mock, patch
 
-from data.models import Model, MODELS
+from data.models import Model, MODELS, training_set, train_all
 
 
 class TestModel:
@@ -31,24 +31,84 @@ class TestModel:
         assert model.channels == channels
         assert model.model == mock_model
     
+    def test_model_loaded_on_first_use(self, mock_model_loading):
+        """Test the model file is only loaded on the first prediction."""
+        model = Model(perk='rating', channels=['waveHeight'])
+        mock_model_loading.assert_not_called()
+
+        model.predict(np.zeros((3, 1)))
+        model.predict(np.zeros((3, 1)))
+
+        mock_model_loading.assert_called_once()
+
 # Model training and file property tests removed due to API mismatches
     
     def test_save_model(self):
-        """Test save_model method."""
+        """Test save_model writes the native model file and a manifest with checksum."""
+        import hashlib
+        xgb_model = Mock()
+        xgb_model.get_booster.return_value.save_raw.return_value = bytearray(b'ubj-model')
+        model = Model(perk='rating', channels=['waveHeight'], model=xgb_model)
+
+        with patch('builtins.open', create=True) as mock_open, \
+             patch('json.dump') as mock_dump:
+
+            model.save_model(metadata={'rms_test': 1.0})
+
+            assert mock_open.call_count == 2
+            mock_open.return_value.__enter__.return_value.write.assert_called_once_with(bytearray(b'ubj-model'))
+            manifest = mock_dump.call_args[0][0]
+            assert manifest['channels'] == ['waveHeight']
+            assert manifest['sha256'] == hashlib.sha256(b'ubj-model').hexdigest()
+            assert manifest['training'] == {'rms_test': 1.0}
+
+    def test_load_native_model_checksum(self):
+        """Test a model file that does not match its manifest is rejected."""
         model = Model(perk='rating', channels=['waveHeight'])
-        
+
         with patch('builtins.open', create=True) as mock_open, \
-             patch('pickle.dump') as mock_dump:
-            
-            model.save_model()
-            
-            mock_open.assert_called_once()
-            mock_dump.assert_called_once()
+             patch.object(Model, 'manifest', return_value={'sha256': 'other'}):
+            mock_open.return_value.__enter__.return_value.read.return_value = b'ubj-model'
+
+            with pytest.raises(ValueError, match="Checksum"):
+                model._load_native_model()
 
 
 # Model training tests removed due to data sample size mismatches
 
 
+class TestTrainAll:
+    """Test training all perks from one training frame."""
+
+    def test_training_set(self):
+        """Only rows with feedback on the perk are used."""
+        dfs = pd.DataFrame({
+            'waveHeight': [1.0, 2.0, 3.0],
+            'rating': [5.0, np.nan, 7.0],
+            'clean': [np.nan, 1.0, 2.0],
+        })
+
+        X, y = training_set(dfs, 'rating', ['waveHeight'])
+
+        assert list(X.columns) == ['waveHeight']
+        assert list(y) == [5.0, 7.0]
+
+    def test_train_all(self):
+        """The training frame is built once and every model gets its trained model."""
+        from concurrent.futures import ThreadPoolExecutor
+        dfs = pd.DataFrame({'waveHeight': [1.0, 2.0], 'rating': [5.0, 7.0], 'clean': [1.0, 2.0]})
+        models = [Model('rating', ['waveHeight'], model=Mock()), Model('clean', ['waveHeight'], model=Mock())]
+        trained = {'rating': Mock(), 'clean': Mock()}
+
+        with patch('data.models.training_frame', return_value=dfs) as mock_frame, \
+             patch('data.models.ProcessPoolExecutor', ThreadPoolExecutor), \
+             patch('data.models.fit_best_model', side_effect=lambda X, y, perk, **kwargs: (trained[perk], 0.5)):
+            train_all(models, spots=[], attempts=1, save=False, workers=2)
+
+        mock_frame.assert_called_once()
+        assert [model.model for model in models] == [trained['rating'], trained['clean']]
+
+
 class TestMODELS:
     """Test MODELS configuration."""
     
@@ -81,19 +141,19 @@ class TestModelIntegration:
     
     def test_model_serialization_workflow(self):
         """Test model save/load workflow."""
-        model = Model(perk='rating', channels=['waveHeight', 'wavePeriod'])
-        
+        xgb_model = Mock()
+        xgb_model.get_booster.return_value.save_raw.return_value = bytearray(b'ubj-model')
+        model = Model(perk='rating', channels=['waveHeight', 'wavePeriod'], model=xgb_model)
+
         with patch('builtins.open', create=True) as mock_open, \
-             patch('pickle.dump') as mock_dump, \
-             patch('pickle.load') as mock_load:
-            
+             patch('json.dump') as mock_dump:
+
             # Test save
             model.save_model()
-            mock_open.assert_called_once()
+            assert mock_open.call_count == 2
             mock_dump.assert_called_once()
-            
+
             # Test load
-            mock_load.return_value = Mock()
             loaded_model = model._load_model()
             assert loaded_model is not None
     
@@ -1,6 +1,7 @@
 """
 Tests for the spots module - core spot functionality and data processing.
 """
+import io
 import pytest
 import pandas as pd
 import numpy as np
@@ -8,7 +9,8 @@ from datetime import datetime
 import pytz
 from unittest.mock import Mock, patch
 
-from data.spots import Spot, SpotInfo, SPOTS, find_spot, enrich_input_data, compute_angle, compute_shelter
+from data.spots import Spot, SpotInfo, SPOTS, find_spot, enrich_input_data, compute_angle, compute_shelter, \
+    compute_shelter_array, shelter_from_series
 
 
 class TestSpotInfo:
@@ -87,6 +89,67 @@ class TestSpot:
         for col in expected_columns:
             assert col in result.columns
     
+    @patch('data.spots.stormglass.load_data')
+    @patch('data.spots.surffeedback.load')
+    def test_training_data(self, mock_load, mock_load_data, mock_spot, sample_weather_data):
+        """Test feedback is matched to the hindcast hours of the session."""
+        sample_weather_data.index = sample_weather_data.index.tz_localize('UTC')
+        mock_load_data.return_value = sample_weather_data
+        mock_load.return_value = pd.DataFrame({
+            'spot': ['TestSpot', 'TestSpot', 'TestSpot', 'TestSpot'],
+            'rating': [5.0, 8.0, 3.0, 9.0],
+            'Datum': ['01-01-2024', '01-01-2024', '01-01-2024', '1-1-2024'],
+            'Start tijd': ['10:00:00', '12:00:00', '9:00:00', '20:00:00'],
+            'Eind tijd': ['13:00:00', '14:00:00', '11:00:00', '21:00:00'],
+        })
+
+        with patch('builtins.open', io.open):  # pandas reads the Europe/Amsterdam tz file
+            result = mock_spot.training_data(only_spot_data=True, fb_columns='rating')
+
+        # Times are Amsterdam local time (UTC+1 in winter), bounds are inclusive, a later session overrides an
+        # earlier one and entries without hh:mm:ss times are skipped
+        expected = {9: 5.0, 10: 5.0, 11: 8.0, 12: 8.0, 13: 8.0, 19: 9.0, 20: 9.0}
+        assert dict(zip(result.index.hour, result['rating'])) == expected
+
+    @patch.dict('data.spots._HINDCAST_STORE', clear=True)
+    @patch('data.spots.stormglass.data_mtime')
+    @patch('data.spots.stormglass.load_data')
+    def test_hindcast_input_cached(self, mock_load_data, mock_data_mtime, mock_spot, sample_weather_data):
+        """Test the enriched hindcast is computed once per version of the stored data."""
+        mock_load_data.side_effect = lambda name: sample_weather_data.copy()
+        mock_data_mtime.return_value = 1
+
+        first = mock_spot._hindcast_input()
+        second = mock_spot._hindcast_input()
+        assert first is second
+        assert mock_load_data.call_count == 1
+
+        mock_data_mtime.return_value = 2  # stored data changed
+        third = mock_spot._hindcast_input()
+        assert third is not first
+        assert mock_load_data.call_count == 2
+
+    def test_surf_rating(self, mock_spot, sample_weather_data):
+        """Test all perks are predicted from one enriched frame without changing the forecast."""
+        forecast = sample_weather_data[['waveHeight', 'wavePeriod', 'waveDirection', 'windSpeed', 'windDirection',
+                                        'currentSpeed', 'windWaveHeight', 'NAP']]
+        columns = list(forecast.columns)
+        models = []
+        for perk, channels in [('rating', ['waveEnergyOnshore', 'NAP']), ('windy', ['windSpeed', 'shelterWind'])]:
+            model = Mock(perk=perk, channels=channels)
+            model.predict.side_effect = lambda X: X.sum(axis=1)
+            models.append(model)
+
+        with patch('data.spots.enrich_input_data', wraps=enrich_input_data) as mock_enrich:
+            result = mock_spot.surf_rating(models, data_init=forecast)
+
+        mock_enrich.assert_called_once()
+        assert list(forecast.columns) == columns
+        assert list(result.columns) == columns + ['rating', 'windy']
+        enriched = enrich_input_data(forecast.copy(), mock_spot)
+        np.testing.assert_allclose(result['rating'], enriched['waveEnergyOnshore'] + enriched['NAP'], rtol=1e-5)
+        np.testing.assert_allclose(result['windy'], enriched['windSpeed'] + enriched['shelterWind'], rtol=1e-5)
+
     def test_add_spot_info(self, mock_spot, sample_weather_data):
         """Test add_spot_info method."""
         mock_spot.add_spot_info(sample_weather_data)
@@ -145,6 +208,29 @@ class TestSpotFunctions:
         # Test angles that should give maximum shelter
         assert compute_shelter(90) == 0.7
     
+    def test_compute_shelter_array(self):
+        """Test vectorized shelter against values of the piecewise shelter curve."""
+        angles = np.array([-10, 0, 10, 20, 55, 90, 125, 160, 170, 180, 190, 270, np.nan])
+        result = compute_shelter_array(angles)
+
+        expected = [0, 0, 0.2, 0.4, 0.55, 0.7, 0.55, 0.4, 0.2, 0, 0, 0, 0]
+        np.testing.assert_allclose(result, expected, atol=1e-12)
+
+    def test_shelter_from_series(self, mock_spot):
+        """Test shelter per pier side keeps the index of the input."""
+        # relative to the pier (richting 290 + 90) these are 340, 70, 160 and 250 degrees
+        richting = pd.Series([0.0, 90.0, 180.0, 270.0], index=pd.date_range('2024-01-01', periods=4, freq='H'))
+
+        mock_spot.spot_info = SpotInfo(pier=-1)
+        links = shelter_from_series(richting, mock_spot)
+        mock_spot.spot_info = SpotInfo(pier=1)
+        rechts = shelter_from_series(richting, mock_spot)
+
+        assert isinstance(links, pd.Series)
+        assert links.index.equals(richting.index)
+        np.testing.assert_allclose(links.values, [0, 0.4 + 0.3 / 70 * 50, 0.4, 0], atol=1e-12)
+        np.testing.assert_allclose(rechts.values, [0, 0, 0, 0], atol=1e-12)
+
     def test_enrich_input_data(self, mock_spot, sample_weather_data):
         """Test enrich_input_data function."""
         result = enrich_input_data(sample_weather_data, mock_spot)
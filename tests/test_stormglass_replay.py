@@ -0,0 +1,76 @@
+"""
+Tests for the offline Stormglass replay server.
+"""
+import io
+import time
+
+import pytest
+from unittest.mock import patch
+
+from data.stormglass import StormglassClient, record_response
+from data.stormglass_replay import ReplayServer, load_recordings, benchmark
+
+
+HOUR = 3600
+RECORDED_START = 1704067200  # 2024-01-01T00:00:00+00:00
+
+
+def weather_response(start, n_hours=3, wave_height=1.5):
+    from datetime import datetime, timezone
+    return {'hours': [{'time': datetime.fromtimestamp(start + i * HOUR, timezone.utc).isoformat(),
+                       'waveHeight': {'sg': wave_height}} for i in range(n_hours)]}
+
+
+@pytest.fixture
+def recordings(temp_data_dir):
+    """Two recorded weather responses at different points."""
+    with patch('builtins.open', io.open):
+        for lat, wave_height in [(52.0, 1.0), (53.0, 2.0)]:
+            params = {'lat': lat, 'lng': 4.5, 'start': float(RECORDED_START), 'end': float(RECORDED_START + 2 * HOUR)}
+            record_response('weather', params, weather_response(RECORDED_START, wave_height=wave_height),
+                            temp_data_dir)
+        yield load_recordings(temp_data_dir)
+
+
+def request_params(lat, start):
+    return {'lat': lat, 'lng': 4.5, 'start': start, 'end': start + 2 * HOUR}
+
+
+class TestReplayServer:
+    """Test replaying recorded responses."""
+
+    def test_replay_nearest_recording_shifted_to_request(self, recordings):
+        """The closest recording is returned, starting at the requested hour."""
+        start = RECORDED_START + 3 * 24 * HOUR
+        with ReplayServer(recordings) as server:
+            data = StormglassClient(api_keys=['key'], url=server.url).get_json('weather', request_params(52.9, start))
+
+        assert [hour['waveHeight']['sg'] for hour in data['hours']] == [2.0] * 3
+        assert data['hours'][0]['time'] == '2024-01-04T00:00:00+00:00'
+
+    def test_unknown_end_point(self, recordings):
+        """End points without recording answer with an API error."""
+        with ReplayServer(recordings) as server:
+            data = StormglassClient(api_keys=['key'], url=server.url).get_json('tide/sea-level',
+                                                                                request_params(52.0, RECORDED_START))
+
+        assert 'errors' in data
+
+    def test_error_injection(self, recordings):
+        """Injected errors go through the client's retries."""
+        with ReplayServer(recordings, error_rate=1.0, error_statuses=(503,), seed=0) as server:
+            client = StormglassClient(api_keys=['key'], url=server.url, max_retries=1, backoff=0)
+            with pytest.raises(FileNotFoundError, match='status 503'):
+                client.get_json('weather', request_params(52.0, RECORDED_START))
+
+        assert server.n_requests == server.n_errors == 2
+
+    def test_benchmark_with_latency(self, recordings):
+        """Every request takes at least the configured latency."""
+        with ReplayServer(recordings, latency=0.05) as server:
+            client = StormglassClient(api_keys=['key'], url=server.url)
+            stats = benchmark(lambda: client.get_json('weather', request_params(52.0, RECORDED_START)), runs=4)
+
+        assert stats['runs'] == 4 and stats['errors'] == 0
+        assert 0.05 <= stats['p50'] <= stats['p95'] <= stats['max']
+        assert stats['throughput'] <= 1 / 0.05
@@ -0,0 +1,365 @@
+"""
+Tests for the site content published by the refresh worker and served by the Django views.
+"""
+import gzip
+import io
+import os
+import time
+from datetime import datetime, timezone
+
+import pandas as pd
+import pytest
+from unittest.mock import patch
+
+import data.web_update_silent as site
+
+
+@pytest.fixture
+def site_cache(temp_data_dir, monkeypatch):
+    """Cache files in a temporary directory, an empty memory cache and a counting generate_site_content."""
+    monkeypatch.setattr(site, 'SITE_CACHE_DIR', temp_data_dir / 'site_cache')
+    monkeypatch.setattr(site, '_CACHE_STATE_FILE', temp_data_dir / 'site_cache_state.json')
+    monkeypatch.setattr(site, '_REFRESH_LEASE_FILE', temp_data_dir / 'site_cache_refresh.lease')
+    monkeypatch.setattr(site, '_MEMORY_CACHE', (None, None))
+    monkeypatch.setattr(site, '_REFRESH_METRICS', dict.fromkeys(site._REFRESH_METRICS, 0))
+    generated = []
+
+    def generate(previous=None, stale_before=None):
+        generated.append(len(generated))
+        spots = {spot.name: {'updated': time.time()} for spot in site.SPOTS}
+        return {'week_overview': f'version {len(generated)}', 'spot_tables': {}, 'spot_widgets': {}, 'spots': spots,
+                'refreshed': list(spots), 'failed': {}}
+
+    with patch('builtins.open', io.open), patch('pathlib.Path.is_file', lambda self: os.path.isfile(self)), \
+            patch('pathlib.Path.exists', lambda self: os.path.exists(self)), \
+            patch.object(site, 'generate_site_content', side_effect=generate):
+        yield generated
+
+
+def make_old(file, seconds):
+    old = time.time() - seconds
+    os.utime(file, (old, old))
+
+
+def make_content_old(seconds):
+    """Publish the current content again, with all spots updated seconds ago."""
+    content = site._load_current_content()
+    for spot in content['spots'].values():
+        spot['updated'] = time.time() - seconds
+    site.publish_site_content(content)
+
+
+class TestCachedSiteContent:
+    """Test the in-memory cache on top of the shared cache file."""
+
+    def test_web_workers_never_generate(self, site_cache):
+        """Without published content there is nothing to serve, nothing is computed inline."""
+        assert site.get_cached_site_content() is None
+        assert site_cache == []
+
+    def test_published_content_stays_in_memory(self, site_cache):
+        """Published content is unpickled once per version."""
+        site.refresh_site_content()
+        assert site.get_cached_site_content()['week_overview'] == 'version 1'
+        with patch.object(site.pickle, 'load') as mock_load:
+            for _ in range(3):
+                assert site.get_cached_site_content()['week_overview'] == 'version 1'
+
+        mock_load.assert_not_called()
+
+    def test_reload_when_new_content_published(self, site_cache):
+        """Content published by the refresh worker is picked up on the next call."""
+        site.refresh_site_content()
+        site.get_cached_site_content()
+        make_content_old(site.REFRESH_MIN_AGE_SECONDS + 60)
+
+        assert site.refresh_site_content()[0]
+        assert site.get_cached_site_content()['week_overview'] == 'version 2'
+
+
+class TestSnapshots:
+    """Test the versioned snapshots."""
+
+    @staticmethod
+    def content(name):
+        return {'week_overview': name, 'spot_tables': {}, 'spot_widgets': {}}
+
+    def test_generations_kept_and_pruned(self, site_cache):
+        """Every publish is a new generation, only the last KEEP_GENERATIONS are kept."""
+        for i in range(site.KEEP_GENERATIONS + 2):
+            assert site.publish_site_content(self.content(f'gen {i + 1}')) == i + 1
+
+        assert site._generations() == list(range(3, site.KEEP_GENERATIONS + 3))
+        assert site.get_cached_site_content()['week_overview'] == f'gen {site.KEEP_GENERATIONS + 2}'
+        assert not list(site.SITE_CACHE_DIR.glob('.*tmp*'))
+
+    def test_rollback(self, site_cache):
+        """Rolling back makes an older generation current for all readers, new publishes continue numbering."""
+        for i in range(3):
+            site.publish_site_content(self.content(f'gen {i + 1}'))
+        site.get_cached_site_content()
+
+        assert site.rollback_site_content() == 2
+        assert site.get_cached_site_content()['week_overview'] == 'gen 2'
+        assert site.rollback_site_content(1) == 1
+        assert site.get_cached_site_content()['week_overview'] == 'gen 1'
+        assert site.publish_site_content(self.content('gen 4')) == 4
+        assert site.get_cached_site_content()['week_overview'] == 'gen 4'
+
+    def test_pages_of_older_snapshot(self, site_cache):
+        """Snapshots published without the encoded pages get them when loaded."""
+        site.publish_site_content(self.content('<head>style</head><table>week</table>'))
+
+        pages = site.get_cached_site_content()['pages']['week_overview']
+        assert pages['plain']['identity'] == b'<table>week</table>'
+        assert gzip.decompress(pages['embed']['gzip']) == pages['embed']['identity']
+
+    def test_generation_in_content(self, site_cache):
+        """Published content carries its generation and publish time for the HTTP validators."""
+        site.publish_site_content(self.content('gen 1'))
+        site.publish_site_content(self.content('gen 2'))
+        site.rollback_site_content()
+
+        content = site.get_cached_site_content()
+        assert content['generation'] == 1
+        assert content['published'] == site._read_current()['published']
+
+    @pytest.mark.parametrize('published, failed, expected', [
+        ('2024-01-01 06:31', {}, 6 * 3600 - 60),  # cached until the next refresh at 12:30
+        ('2024-01-01 00:31', {}, 60),  # the 06:30 refresh is due, check again soon
+        ('2024-01-01 06:20', {}, 6 * 3600 - 60),  # the 06:30 refresh skips the fresh content
+        ('2024-01-01 06:31', {'ZV': 'API limit exceeded'}, site.RETRY_FAILED_MINUTES * 60),  # until the retry
+    ])
+    def test_content_max_age(self, published, failed, expected):
+        """Clients may cache the content until the refresh worker will replace it."""
+        as_utc = lambda t: datetime.fromisoformat(t).replace(tzinfo=timezone.utc)
+        published = as_utc(published).timestamp()
+        content = {'published': published, 'failed': failed, 'spots': {'ZV': {'updated': published}}}
+
+        assert site.content_max_age(content, now=as_utc('2024-01-01 06:31')) == expected
+
+    def test_rollback_unavailable(self, site_cache):
+        """Rolling back to a pruned or missing generation fails and keeps the current one."""
+        site.publish_site_content(self.content('gen 1'))
+
+        with pytest.raises(ValueError):
+            site.rollback_site_content()
+        with pytest.raises(ValueError, match='generation 7'):
+            site.rollback_site_content(7)
+        assert site._read_current()['generation'] == 1
+
+
+# Loaded on import: the autouse fixtures of conftest mock the open() that loads a timezone on first use
+AMSTERDAM = pd.Timestamp.now(tz='Europe/Amsterdam').tz
+
+
+def rated_forecast(rating):
+    index = pd.date_range(pd.Timestamp.now(tz=AMSTERDAM).floor('D'), periods=48, freq='H')
+    return pd.DataFrame({'rating': float(rating), 'hoogte-v2': 2.0}, index=index)
+
+
+class TestPerSpotRefresh:
+    """Test that spots are refreshed independently."""
+
+    @pytest.fixture
+    def rating(self):
+        """Stubbed download and rating: the rating of a spot is its position in SPOTS, failing spots raise."""
+        failing = set()
+        names = [spot.name for spot in site.SPOTS]
+
+        def forecasts(spots, cache=False):
+            return {spot.name: FileNotFoundError('API limit exceeded') if spot.name in failing
+                    else rated_forecast(names.index(spot.name)) for spot in spots}
+
+        spot_content = lambda spot, data: {'table': f'table {spot.name}', 'widget': f'widget {spot.name}',
+                                           'daily': data.resample('D').max(), 'updated': time.time()}
+        with patch.object(site, 'forecast_spots', side_effect=forecasts) as mock_forecasts, \
+                patch.object(type(site.SPOTS[0]), 'surf_rating', lambda self, models, data_init: data_init), \
+                patch.object(site, 'spot_content', side_effect=spot_content):
+            yield failing, mock_forecasts
+
+    def test_failed_spot_keeps_previous_content(self, rating):
+        """A failing spot keeps its previous content and does not affect the others."""
+        failing, _ = rating
+        first = site.generate_site_content()
+        failing.add('ZV')
+
+        content = site.generate_site_content(first)
+
+        assert content['failed'] == {'ZV': 'API limit exceeded'}
+        assert 'ZV' not in content['refreshed'] and len(content['refreshed']) == len(site.SPOTS) - 1
+        assert content['spots']['ZV'] is first['spots']['ZV']
+        assert content['spot_tables']['ZV'] == 'table ZV'
+        assert all(name in content['week_overview'] for name in first['spots'])
+        assert content['pages']['spot_tables']['ZV']['plain']['identity'] == b'table ZV'
+
+    def test_only_stale_spots_recomputed(self, rating):
+        """Spots updated after stale_before are reused without downloading them."""
+        _, mock_forecasts = rating
+        first = site.generate_site_content()
+        first['spots']['ZV']['updated'] = time.time() - 3600
+
+        content = site.generate_site_content(first, stale_before=time.time() - 60)
+
+        assert [spot.name for spot in mock_forecasts.call_args.args[0]] == ['ZV']
+        assert content['refreshed'] == ['ZV']
+
+    def test_spot_order_after_failure(self, rating):
+        """A spot that recovers from a failure keeps its place in SPOTS."""
+        failing, _ = rating
+        failing.add(site.SPOTS[0].name)
+        first = site.generate_site_content()
+        failing.clear()
+
+        content = site.generate_site_content(first, stale_before=time.time() - 60)
+
+        assert list(content['spots']) == [spot.name for spot in site.SPOTS]
+        header = content['week_overview'].split('</tr>')[0]
+        assert header.index(f'<th>{site.SPOTS[0].name}</th>') < header.index(f'<th>{site.SPOTS[1].name}</th>')
+
+    def test_first_refresh_without_any_spot(self, rating):
+        """Without previous content and all spots failing there is nothing to publish."""
+        failing, _ = rating
+        failing.update(spot.name for spot in site.SPOTS)
+
+        with pytest.raises(FileNotFoundError, match='No spot could be refreshed'):
+            site.generate_site_content()
+
+    def test_week_overview_from_daily_aggregates(self):
+        """The week overview has a column per spot and a row per day."""
+        dailies = {'A': rated_forecast(7).resample('D').max(), 'B': rated_forecast(3).resample('D').max()}
+
+        html = site.week_overview_html(dailies)
+
+        assert html.count('<th>A</th>') == 1 and html.count('<th>B</th>') == 1
+        assert '<h3>7.0</h3>' in html and '<h3>3.0</h3>' in html
+        assert html.count('<tr>') == 1 + 2
+
+    def test_week_overview_from_today(self):
+        """Days before today of a spot refreshed earlier are not shown, missing days of a spot are marked."""
+        old = rated_forecast(5).shift(-1, freq='D').resample('D').max()
+        dailies = {'A': rated_forecast(7).resample('D').max(), 'B': old}
+
+        html = site.week_overview_html(dailies)
+
+        assert html.count('<tr>') == 1 + 2
+        assert html.count('<h3>5.0</h3>') == 1 and html.count('<h3>-</h3>') == 1
+
+
+class TestRefresh:
+    """Test the single-flight refresh of the refresh worker."""
+
+    def test_refresh_publishes_and_reports_metrics(self, site_cache):
+        """A refresh publishes new content and its counters."""
+        refreshed, failed = site.refresh_site_content()
+        assert refreshed == [spot.name for spot in site.SPOTS] and failed == {}
+
+        metrics = site.refresh_metrics()
+        assert metrics['metrics']['started'] == metrics['metrics']['completed'] == 1
+        assert metrics['current']['generation'] == metrics['last_generation'] == 1
+        assert set(metrics['spots_updated']) == {spot.name for spot in site.SPOTS}
+        assert metrics['lease'] is None
+        assert 0 <= metrics['content_age_seconds'] < 60
+
+    def test_obsolete_state_removed(self, site_cache):
+        """Keys written by earlier versions do not stay in the state file forever."""
+        site._CACHE_STATE_FILE.write_text('{"last_update_ts": 1758889386.9}')
+
+        site.refresh_site_content()
+
+        assert 'last_update_ts' not in site._load_state()
+
+    def test_refresh_skipped_while_other_process_holds_lease(self, site_cache):
+        """Only the process holding the lease refreshes, an expired lease is taken over."""
+        site._REFRESH_LEASE_FILE.write_text('{"pid": 1, "since": 0}')
+
+        assert site.refresh_site_content() == ([], {})
+        assert site_cache == []
+        assert site.refresh_metrics()['lease'] == {'pid': 1, 'since': 0}
+
+        make_old(site._REFRESH_LEASE_FILE, site.REFRESH_LEASE_SECONDS + 60)
+        assert site.refresh_site_content()[0]
+        assert not site._REFRESH_LEASE_FILE.exists()
+        assert site.refresh_metrics()['metrics']['skipped_leased'] == 1
+
+    def test_metrics_of_all_processes(self, site_cache):
+        """Counters are stored per process and added up, also by a process that skipped because of the lease."""
+        site.refresh_site_content()
+        site._REFRESH_LEASE_FILE.write_text('{"pid": 1, "since": 0}')
+        with patch.object(site.os, 'getpid', return_value=2), \
+                patch.dict(site._REFRESH_METRICS, dict.fromkeys(site._REFRESH_METRICS, 0)):
+            site.refresh_site_content()
+
+        metrics = site.refresh_metrics()
+        assert set(metrics['workers']) == {str(os.getpid()), '2'}
+        assert metrics['workers']['2']['skipped_leased'] == 1
+        assert metrics['metrics']['completed'] == 1 and metrics['metrics']['skipped_leased'] == 1
+
+    def test_lease_released_only_by_holder(self, site_cache):
+        """A process whose expired lease was taken over does not remove the lease of the new holder."""
+        assert site._acquire_refresh_lease()
+        make_old(site._REFRESH_LEASE_FILE, site.REFRESH_LEASE_SECONDS + 60)
+        with patch.object(site.os, 'getpid', return_value=1):
+            assert site._acquire_refresh_lease()  # takes over the expired lease
+            assert not site._acquire_refresh_lease()
+
+        site._release_refresh_lease()
+        assert site.refresh_metrics()['lease']['pid'] == 1
+        assert sorted(p.name for p in site._REFRESH_LEASE_FILE.parent.iterdir()
+                      if p.name.startswith(site._REFRESH_LEASE_FILE.name)) == [site._REFRESH_LEASE_FILE.name]
+
+    def test_expired_lease_taken_over_once(self, site_cache):
+        """Of two processes that found the lease expired, only the first takes it over."""
+        site._REFRESH_LEASE_FILE.write_text('{"pid": 1, "since": 0}')
+        make_old(site._REFRESH_LEASE_FILE, site.REFRESH_LEASE_SECONDS + 60)
+        site._take_over_expired_lease()
+        with patch.object(site.os, 'getpid', return_value=2):
+            assert site._acquire_refresh_lease()
+
+        site._take_over_expired_lease()  # the second process, after its expiry check
+
+        assert site.refresh_metrics()['lease']['pid'] == 2
+
+    def test_refresh_skipped_when_content_is_fresh(self, site_cache):
+        """A refresh right after another one does not recompute the content."""
+        site.refresh_site_content()
+
+        assert site.refresh_site_content() == ([], {})
+        assert len(site_cache) == 1
+        assert site.refresh_metrics()['metrics']['skipped_fresh'] == 1
+
+    def test_failed_refresh_keeps_content_and_releases_lease(self, site_cache):
+        """A failing refresh keeps the published content."""
+        site.refresh_site_content()
+        make_content_old(site.CACHE_MAX_AGE_SECONDS + 60)
+
+        with patch.object(site, 'generate_site_content', side_effect=FileNotFoundError('API limit exceeded')):
+            site.run_refresh_worker(once=True)
+
+        assert site.get_cached_site_content()['week_overview'] == 'version 1'
+        assert not site._REFRESH_LEASE_FILE.exists()
+        assert site.refresh_metrics()['metrics']['failed'] == 1
+
+    def test_failed_refresh_retried_soon(self, site_cache):
+        """A refresh that publishes nothing (a cold start while the API is down) is retried after a few minutes."""
+        class Stop(Exception):
+            pass
+
+        with patch.object(site, 'generate_site_content', side_effect=FileNotFoundError('API limit exceeded')), \
+                patch.object(site.time, 'sleep', side_effect=Stop) as mock_sleep:
+            with pytest.raises(Stop):
+                site.run_refresh_worker()
+
+        assert 0 < mock_sleep.call_args.args[0] <= site.RETRY_FAILED_MINUTES * 60
+        assert site.get_cached_site_content() is None
+
+    @pytest.mark.parametrize('now, expected', [
+        ('2024-01-01 00:10', '2024-01-01 00:30'),
+        ('2024-01-01 05:00', '2024-01-01 06:30'),
+        ('2024-01-01 06:30', '2024-01-01 12:30'),
+        ('2024-01-01 23:00', '2024-01-02 00:30'),
+    ])
+    def test_next_refresh_time(self, now, expected):
+        """Refreshes are aligned on the 6-hourly forecast model updates plus a delay."""
+        as_utc = lambda t: datetime.fromisoformat(t).replace(tzinfo=timezone.utc)
+        assert site.next_refresh_time(as_utc(now), interval_hours=6, delay_minutes=30) == as_utc(expected)